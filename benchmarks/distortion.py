@@ -0,0 +1,61 @@
+"""
+Distortion kernel benchmark: nearest vs bilinear, serial vs row-parallel.
+
+Usage (from the repo root):
+    NUMBA_NUM_THREADS=8 python -m benchmarks.distortion [size ...]
+
+For every image size and thread count (1/2/4/8, capped at NUMBA_NUM_THREADS)
+reports the time to build a remap table (cache miss) and to apply a cached
+one (cache hit), in milliseconds.
+"""
+import sys
+import time
+import numba
+import numpy as np
+
+from utils import effects
+
+THREADS = (1, 2, 4, 8)
+REPEATS = 20
+
+def timed(func, *args):
+    func(*args)
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        func(*args)
+    return (time.perf_counter() - start) / REPEATS * 1000
+
+def run(sizes):
+    effects.warm_up()
+    max_threads = numba.config.NUMBA_NUM_THREADS
+    threads = [t for t in THREADS if t <= max_threads]
+    if len(threads) < len(THREADS):
+        print(f"NUMBA_NUM_THREADS={max_threads}, skipping {[t for t in THREADS if t > max_threads]} threads")
+
+    print(f"{'kernel':<24} {'size':>6} {'threads':>7} {'build ms':>9} {'apply ms':>9}")
+    for size in sizes:
+        h, w = size, size * 3 // 4
+        img = np.random.randint(0, 256, (h, w, 3), dtype=np.uint8)
+        radius = min(h, w) * 0.9 / 2
+
+        for name, params in (("swirl", (radius, 5.0)), ("lens", (-0.5,))):
+            for sampling in ("nearest", "bilinear"):
+                serial_build, parallel_build = effects._DISTORTION_BUILDERS[(name, sampling)]
+                serial_apply, parallel_apply = effects._SAMPLERS[sampling]
+                table = serial_build(h, w, *params)
+
+                label = f"{name}/{sampling}"
+                build = timed(serial_build, h, w, *params)
+                apply = timed(serial_apply, img, table)
+                print(f"{label:<24} {size:>6} {'serial':>7} {build:9.2f} {apply:9.2f}")
+
+                for t in threads:
+                    numba.set_num_threads(t)
+                    build = timed(parallel_build, h, w, *params)
+                    apply = timed(parallel_apply, img, table)
+                    print(f"{label:<24} {size:>6} {t:>7} {build:9.2f} {apply:9.2f}")
+                numba.set_num_threads(max_threads)
+
+if __name__ == "__main__":
+    sizes = [int(s) for s in sys.argv[1:]] or [600, 1200]
+    run(sizes)
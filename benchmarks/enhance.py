@@ -0,0 +1,86 @@
+"""
+Deep fry / crispy benchmark: ImageEnhance chain vs the fused kernels.
+
+Usage (from the repo root):
+    python -m benchmarks.enhance [templates]
+
+For every template reports the time of both versions in milliseconds, the
+peak numpy memory they allocate and whether the outputs are identical.
+tracemalloc does not see Pillow's own buffers, so the chain's figure leaves
+out its intermediate images (two or three full RGB images per enhance step);
+the fused version has none. Noise is seeded the same way for both, so deep
+fry should match bit for bit.
+"""
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+from PIL import Image, ImageEnhance
+
+import config
+from utils import effects
+
+REPEATS = 5
+
+def deep_fry_chain(img):
+    # The ImageEnhance implementation deep_fry_effect replaced
+    img = effects.resize_image_keep_ratio(img, max_size=config.EFFECTS_MAX_SIZE_DEEPFRY)
+    img_arr = np.array(img)
+    noise = np.random.randint(config.DEEPFRY_NOISE_RANGE[0], config.DEEPFRY_NOISE_RANGE[1], img_arr.shape, dtype='uint8')
+    img = Image.fromarray(np.clip(img_arr.astype(int) + noise, 0, 255).astype('uint8'))
+    img = ImageEnhance.Color(img).enhance(config.DEEPFRY_COLOR_ENHANCE_FACTOR)
+    img = ImageEnhance.Contrast(img).enhance(config.DEEPFRY_CONTRAST_ENHANCE_FACTOR)
+    return ImageEnhance.Sharpness(img).enhance(config.DEEPFRY_SHARPNESS_ENHANCE_FACTOR)
+
+def crispy_chain(img):
+    # The ImageEnhance implementation crispy_effect replaced
+    img = effects.resize_image_keep_ratio(img, max_size=config.EFFECTS_MAX_SIZE_CRISPY)
+    img = ImageEnhance.Sharpness(img).enhance(config.CRISPY_SHARPNESS_ENHANCE_FACTOR)
+    img = ImageEnhance.Contrast(img).enhance(config.CRISPY_CONTRAST_ENHANCE_FACTOR)
+    return ImageEnhance.Brightness(img).enhance(config.CRISPY_BRIGHTNESS_ENHANCE_FACTOR)
+
+CASES = {
+    "deepfry": (deep_fry_chain, effects.deep_fry_effect),
+    "crispy": (crispy_chain, effects.crispy_effect),
+}
+
+def measure(func, img):
+    """Returns (output array, ms per call, peak numpy MB)."""
+    np.random.seed(0)
+    tracemalloc.start()
+    out = np.array(func(img))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        func(img)
+    elapsed = (time.perf_counter() - start) / REPEATS * 1000
+    return out, elapsed, peak / 1024 / 1024
+
+def load(name):
+    return Image.open(os.path.join(config.TEMPLATE_DIR, name)).convert("RGB")
+
+def run(limit):
+    effects.warm_up()
+    templates = sorted(os.listdir(config.TEMPLATE_DIR))[:limit]
+
+    print(f"{'template':<32} {'effect':<8} {'chain ms':>9} {'fused ms':>9} {'chain np':>9} {'fused np':>9} {'same':>5}")
+    totals = {name: [0.0, 0.0] for name in CASES}
+    for template in templates:
+        img = load(template)
+        for name, (chain, fused) in CASES.items():
+            expected, t_chain, mem_chain = measure(chain, img)
+            actual, t_fused, mem_fused = measure(fused, img)
+            totals[name][0] += t_chain
+            totals[name][1] += t_fused
+            same = "yes" if np.array_equal(expected, actual) else "NO"
+            print(f"{template[:32]:<32} {name:<8} {t_chain:9.1f} {t_fused:9.1f} {mem_chain:9.1f} {mem_fused:9.1f} {same:>5}")
+
+    for name, (t_chain, t_fused) in totals.items():
+        print(f"{'total':<32} {name:<8} {t_chain:9.1f} {t_fused:9.1f}")
+
+if __name__ == "__main__":
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    run(limit)
@@ -0,0 +1,67 @@
+"""
+Liquid resize benchmark: exact vs batch seam removal.
+
+Usage (from the repo root):
+    python -m benchmarks.liquid_resize [max_size] [templates]
+
+Reports time per template for both modes, PSNR of the batch result
+against the exact one (higher = closer, inf = identical) and the mean
+gradient energy kept in each output (higher = more detail preserved).
+"""
+import os
+import sys
+import time
+import numpy as np
+from PIL import Image
+
+import config
+from utils import effects
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float("inf")
+    return 10 * np.log10(255.0 ** 2 / mse)
+
+def mean_energy(arr):
+    return float(np.mean(effects.calc_energy(arr)))
+
+def load(name):
+    return Image.open(os.path.join(config.TEMPLATE_DIR, name)).convert("RGB")
+
+def run(max_size, limit):
+    config.LIQUID_RESIZE_MAX_SIZE = max_size
+    config.LIQUID_RESIZE_SEAM_SAFETY_LIMIT = max_size
+    effects.warm_up()
+
+    templates = sorted(os.listdir(config.TEMPLATE_DIR))[:limit]
+    # Untimed pass so both modes start from a warm process
+    for mode in ("exact", "batch"):
+        effects.liquid_resize(load(templates[0]), mode=mode)
+
+    print(f"max_size={max_size} batch_seams={config.LIQUID_RESIZE_BATCH_SEAMS}")
+    print(f"{'template':<40} {'exact s':>8} {'batch s':>8} {'PSNR dB':>8} {'E exact':>8} {'E batch':>8}")
+
+    total_exact = total_batch = 0.0
+    for name in templates:
+        img = load(name)
+        results = {}
+        for mode in ("exact", "batch"):
+            start = time.perf_counter()
+            out = effects.liquid_resize(img, mode=mode)
+            elapsed = time.perf_counter() - start
+            results[mode] = (np.array(out), elapsed)
+
+        exact, t_exact = results["exact"]
+        batch, t_batch = results["batch"]
+        total_exact += t_exact
+        total_batch += t_batch
+        print(f"{name[:40]:<40} {t_exact:8.2f} {t_batch:8.2f} {psnr(exact, batch):8.1f} "
+              f"{mean_energy(exact):8.1f} {mean_energy(batch):8.1f}")
+
+    print(f"{'total':<40} {total_exact:8.2f} {total_batch:8.2f}")
+
+if __name__ == "__main__":
+    max_size = int(sys.argv[1]) if len(sys.argv) > 1 else config.LIQUID_RESIZE_MAX_SIZE
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    run(max_size, limit)
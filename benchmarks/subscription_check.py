@@ -0,0 +1,52 @@
+"""
+Subscription check benchmark: uncached vs cached get_chat_member.
+
+Usage (from the repo root):
+    python -m benchmarks.subscription_check [users] [callbacks_per_user] [rtt_ms]
+
+Simulates users scrolling the gallery (one subscription check per callback)
+against a fake Bot API with a fixed round-trip time, and reports API calls
+and the mean time each check adds to a callback.
+"""
+import asyncio
+import sys
+import time
+from types import SimpleNamespace
+
+import main
+
+class FakeBot:
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.calls = 0
+
+    async def get_chat_member(self, chat_id, user_id):
+        self.calls += 1
+        await asyncio.sleep(self.rtt)
+        return SimpleNamespace(status="member")
+
+async def session(context, users, callbacks, use_cache):
+    main._subscription_cache.clear()
+    context.bot.calls = 0
+    start = time.perf_counter()
+    for _ in range(callbacks):
+        for user_id in range(users):
+            await main.check_subscription(user_id, context, use_cache=use_cache)
+    elapsed = time.perf_counter() - start
+    return context.bot.calls, elapsed / (users * callbacks) * 1000
+
+async def run(users, callbacks, rtt_ms):
+    context = SimpleNamespace(bot=FakeBot(rtt_ms / 1000))
+    print(f"users={users} callbacks/user={callbacks} rtt={rtt_ms} ms")
+    print(f"{'mode':<10} {'API calls':>10} {'ms/check':>9}")
+    for label, use_cache in (("uncached", False), ("cached", True)):
+        calls, per_check = await session(context, users, callbacks, use_cache)
+        if not use_cache and not calls:
+            sys.exit("uncached run made no get_chat_member calls: check_subscription no longer reaches the bot")
+        print(f"{label:<10} {calls:>10} {per_check:9.2f}")
+
+if __name__ == "__main__":
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    callbacks = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+    rtt_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 80
+    asyncio.run(run(users, callbacks, rtt_ms))
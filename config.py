@@ -5,12 +5,46 @@ import os
 # --- General Configuration ---
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHANNEL_USERNAME = os.getenv("CHANNEL_USERNAME", "@dopamemechan")
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()} # Telegram user ids allowed to run admin commands
+
+# --- Web Server (web_server.py) ---
+PORT = int(os.getenv("PORT", "8080")) # /health, /ready and the webhook are served here
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") # Public base URL, e.g. https://bot.example.com; unset = long polling
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram") # Where Telegram posts updates
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") # Checked against Telegram's secret token header (A-Z, a-z, 0-9, _ and -)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40")) # Parallel update deliveries Telegram may open
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32")) # Updates handled at once; one user's updates still run one by one (update_processor.py)
+BOT_API_CONNECTIONS = 256 # HTTP connection pool for Bot API calls (python-telegram-bot's default)
+
+# --- Metrics (metrics.py), served on /metrics ---
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0) # Histogram upper bounds, seconds
+
+# --- Subscription Check Cache ---
+SUBSCRIPTION_CACHE_SIZE = 10000 # Users remembered at once (LRU eviction)
+SUBSCRIPTION_TTL_POSITIVE = 600 # Seconds to trust "subscribed" before asking Telegram again
+SUBSCRIPTION_TTL_NEGATIVE = 30 # Seconds to trust "not subscribed"; the "I subscribed" button bypasses it
 
 # --- Directories ---
 TEMPLATE_DIR = "assets/templates"
-USER_UPLOAD_DIR = "assets/user_uploads"
-GENERATED_DIR = "assets/generated"
 FONTS_DIR = "assets/fonts"
+DATA_DIR = os.getenv("DATA_DIR", "data") # Persistent bot state; mount as a volume in Docker
+
+# --- Result Cache (result_cache.py) ---
+RESULT_CACHE_MAX_ITEMS = 2000 # Finished renders kept in the bot process
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "64")) # Byte budget for their encoded bytes
+RESULT_CACHE_TTL = 6 * 3600 # Seconds; Telegram file_ids stay valid much longer, this bounds stale memory
+
+# --- Upload Cache (upload_cache.py) ---
+UPLOAD_CACHE_MAX_MB = int(os.getenv("UPLOAD_CACHE_MAX_MB", "64")) # Downloaded user photos kept in the bot process
+UPLOAD_CACHE_TTL = 3600 # Seconds a downloaded photo is reused for repeat triggers
+
+# --- Template Index (template_index.py) ---
+TEMPLATE_INDEX_PATH = os.path.join(DATA_DIR, "template_index.json") # Stable template ids, dimensions, hashes
+TEMPLATE_INDEX_REFRESH_INTERVAL = 30 # Seconds between background rescans of TEMPLATE_DIR
+
+# --- Gallery file_id cache ---
+TEMPLATE_FILE_ID_INDEX = os.path.join(DATA_DIR, "template_file_ids.json") # template path -> Telegram file_id
+TEMPLATE_PRELOAD_DELAY = 0.5 # Seconds between uploads in /preload, to stay under Telegram rate limits
 
 # --- Telegram Bot States ---
 WAITING_MEME_TEXT = 1
@@ -20,6 +54,18 @@ WAITING_DEMOTIVATOR_TEXT = 2
 STICKER_SIZE = 512 # One side exactly 512px, the other <= 512px
 STICKER_EMOJI = "😀" # Default emoji for stickers
 STICKER_FORMAT = "static" # Telegram sticker format
+STICKER_MAX_BYTES = 512 * 1024 # Telegram's limit for a static sticker file
+STICKER_WEBP_QUALITY = 90 # First try; lowered in steps of 10 until the sticker fits STICKER_MAX_BYTES
+STICKER_WEBP_MIN_QUALITY = 50
+STICKER_WEBP_METHOD = 2 # libwebp effort 0-6: 2 is ~2x faster than the default 4 at the same size
+
+# Bulk pack building (/pack and albums)
+STICKER_BULK_MAX = 20 # Stickers one /pack command or album may add
+STICKER_SET_INITIAL_MAX = 50 # Bot API limit: stickers create_new_sticker_set takes at once
+STICKER_ADD_INTERVAL = 0.5 # Seconds between add_sticker_to_set calls, to stay under flood limits
+STICKER_FLOOD_RETRIES = 3 # Retries of a sticker call after Telegram answers RetryAfter
+ALBUM_COLLECT_DELAY = 1.5 # Seconds to wait for more photos of an album after the last one arrived
+PROGRESS_EDIT_INTERVAL = 1.0 # Minimum seconds between edits of a progress message
 
 # --- Image Generation Configuration (image_generator.py) ---
 MEME_FONT_NAME = "Impact"
@@ -28,6 +74,11 @@ WATERMARK_TEXT = "@dopamemerobot"
 WATERMARK_FONT_SIZE_FACTOR = 0.035 # Factor of min(width, height) for watermark font size
 WATERMARK_OUTLINE_WIDTH_FACTOR = 15 # Outline width = font_size // this factor
 WATERMARK_ALPHA = 153 # Alpha transparency for watermark (out of 255)
+WATERMARK_SPRITE_CACHE_SIZE = 32 # Pre-rendered watermarks, one per font size
+
+TEXT_LAYOUT_CACHE_SIZE = 256 # Cached caption layouts (wrapped lines + line sizes) per worker
+WRAP_WORD_CACHE_SIZE = 4096 # Measured words per font size (wrap_text)
+WRAP_KERNING_CACHE_SIZE = 4096 # Kerning pairs per font size (wrap_text)
 
 # Meme specific
 MEME_TOP_TEXT_Y_OFFSET = 10
@@ -46,14 +97,26 @@ DEMOTIVATOR_PADDING_SIDE = 50
 DEMOTIVATOR_PADDING_BOTTOM_MIN = 100
 DEMOTIVATOR_LINE_SPACING = 15 # Added to font_size for line height
 
+# --- Render Engine (render_engine.py) ---
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "2")) # Worker processes for CPU-bound image work
+RENDER_MAX_QUEUE = int(os.getenv("RENDER_MAX_QUEUE", "16")) # Jobs allowed to wait or run at once
+RENDER_USER_MAX_RUNNING = int(os.getenv("RENDER_USER_MAX_RUNNING", "1")) # Interactive jobs of one user running at once; the rest wait
+RENDER_WARM_UP_BEFORE_POLLING = os.getenv("RENDER_WARM_UP_BEFORE_POLLING", "0") == "1" # Otherwise workers warm up in the background
+
+# --- Template Store (template_store.py) ---
+TEMPLATE_STORE_MAX_MB = int(os.getenv("TEMPLATE_STORE_MAX_MB", "128")) # Decoded templates and uploads kept per worker
+
 # --- Effect Configuration (effects.py) ---
 EFFECTS_MAX_SIZE_DEFAULT = 600 # Default max size for images before applying effects
 EFFECTS_MAX_SIZE_DEEPFRY = 800 # Specific max size for deep fry
 EFFECTS_MAX_SIZE_CRISPY = 800 # Specific max size for crispy
+EFFECT_CHAIN_MAX_LENGTH = 4 # Effects a user can stack into one render
 
 # Liquid Resize
 LIQUID_RESIZE_MAX_SIZE = 500
 LIQUID_RESIZE_SEAM_SAFETY_LIMIT = 200 # Max seams to remove in one dimension
+LIQUID_RESIZE_MODE = "exact" # "exact": one seam per DP pass, "batch": several per pass (faster on big images)
+LIQUID_RESIZE_BATCH_SEAMS = 8 # Seams removed per DP pass in batch mode
 
 # Deep Fry
 DEEPFRY_NOISE_RANGE = (0, 25) # Min, Max for noise
@@ -62,21 +125,62 @@ DEEPFRY_CONTRAST_ENHANCE_FACTOR = 2.0
 DEEPFRY_SHARPNESS_ENHANCE_FACTOR = 5.0
 DEEPFRY_JPEG_QUALITY = 8
 
+# Remap tables for Warp / Bulge / Pinch (one per image size and parameters)
+REMAP_CACHE_SIZE = 16 # ~1.4 MB each at 600x600 (nearest), ~2.9 MB (bilinear)
+# Per effect: *_SAMPLING is "nearest" or "bilinear" (smoother, a bit slower),
+# *_PARALLEL runs the numba kernels row-parallel on all cores of the worker.
+EFFECTS_NUMBA_THREADS = int(os.getenv("EFFECTS_NUMBA_THREADS", "0")) # Threads per render worker, 0 = numba default
+
 # Warp (Swirl)
 WARP_STRENGTH = 5.0
+WARP_SAMPLING = "nearest"
+WARP_PARALLEL = False
 
 # Lens (Bulge/Pinch)
 BULGE_K_VALUE = -0.5 # Negative for bulge
 PINCH_K_VALUE = 0.5  # Positive for pinch
+BULGE_SAMPLING = "nearest"
+BULGE_PARALLEL = False
+PINCH_SAMPLING = "nearest"
+PINCH_PARALLEL = False
 
 # Crispy
 CRISPY_SHARPNESS_ENHANCE_FACTOR = 15.0
 CRISPY_CONTRAST_ENHANCE_FACTOR = 3.0
 CRISPY_BRIGHTNESS_ENHANCE_FACTOR = 1.5
 
+# --- Input Resolution per Operation ---
+# Longest side each operation works at: the bot downloads the smallest PhotoSize
+# that covers it, and workers JPEG-draft-decode down to it. None = full size.
+OPERATION_INPUT_SIZE = {
+    "liquid": LIQUID_RESIZE_MAX_SIZE,
+    "deepfry": EFFECTS_MAX_SIZE_DEEPFRY,
+    "crispy": EFFECTS_MAX_SIZE_CRISPY,
+    "warp": EFFECTS_MAX_SIZE_DEFAULT,
+    "bulge": EFFECTS_MAX_SIZE_DEFAULT,
+    "pinch": EFFECTS_MAX_SIZE_DEFAULT,
+    "meme": None,
+    "demotivator": None,
+}
+
+# Rough seconds of worker time per operation. The render queue starts cheap jobs
+# first (a text meme overtakes a liquid resize submitted just before it), while
+# a job waiting longer than its cost goes ahead of newer expensive ones.
+RENDER_JOB_COST = {
+    "meme": 0.05,
+    "demotivator": 0.05,
+    "crispy": 0.1,
+    "deepfry": 0.1,
+    "warp": 0.1,
+    "bulge": 0.1,
+    "pinch": 0.1,
+    "liquid": 2.0,
+}
+
 # --- Callback Data ---
 CALLBACK_MODE_MEME = "mode_meme"
 CALLBACK_MODE_PACK = "mode_pack"
+CALLBACK_CHECK_SUBSCRIPTION = "check_subscription"
 
 CALLBACK_STICKER_CONTINUE = "sticker_continue"
 CALLBACK_STICKER_FINISH = "sticker_finish"
@@ -91,6 +195,8 @@ CALLBACK_EFFECT_WARP = "effect_warp"
 CALLBACK_EFFECT_CRISPY = "effect_crispy"
 CALLBACK_EFFECT_BULGE = "effect_bulge"
 CALLBACK_EFFECT_PINCH = "effect_pinch"
+CALLBACK_EFFECT_APPLY = "effect_apply"
+CALLBACK_EFFECT_UNDO = "effect_undo"
 CALLBACK_BACK_TO_USER_PHOTO = "back_to_user_photo"
 
 # Gallery navigation
@@ -1,14 +1,33 @@
+from utils import startup_timing
 import os
 import logging
 import uuid
 import asyncio
 import random
-from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputSticker
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ConversationHandler
+import re
+import time
+import weakref
 
-from utils.image_generator import generate_meme, generate_demotivator, prepare_for_sticker
-from utils.effects import liquid_resize, deep_fry_effect, warp_effect, crispy_effect, lens_bulge_effect, lens_pinch_effect
+with startup_timing.stage("import dotenv"):
+    from dotenv import load_dotenv
+with startup_timing.stage("import telegram"):
+    from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputSticker, Message
+    from telegram.error import BadRequest, RetryAfter, TelegramError
+    from telegram.request import HTTPXRequest
+    from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ConversationHandler, TypeHandler
+
+# Генераторы и эффекты (Pillow, numpy, scipy, numba) здесь не импортируются:
+# render_engine вызывает их по имени "модуль:функция" внутри воркеров.
+with startup_timing.stage("import render_engine"):
+    from utils import render_engine
+    from utils.render_engine import RenderQueueFull, RenderCancelled
+from utils.file_id_cache import FileIdIndex
+from utils.template_index import TemplateIndex
+from utils.cache import LRUCache
+from utils import effect_chain, metrics, result_cache, upload_cache
+from utils.upload_cache import Upload
+from utils import web_server
+from utils.update_processor import PerUserUpdateProcessor
 import config
 
 # Загрузка переменных окружения
@@ -20,46 +39,82 @@ logging.basicConfig(
     level=logging.INFO
 )
 
-# Директории
-if not os.path.exists(config.USER_UPLOAD_DIR):
-    os.makedirs(config.USER_UPLOAD_DIR)
+BUSY_TEXT = "⏳ Бот сейчас перегружен, попробуйте через минуту."
+CANCELLED_TEXT = "⏹ Отменено: вы запустили новую обработку."
 
-# Caching for templates
-_templates_cache = None
+# Индекс шаблонов: стабильные id для callback-кнопок, обновляется в фоне без рестарта
+template_index = TemplateIndex(config.TEMPLATE_DIR, config.TEMPLATE_INDEX_PATH)
+_template_refresh_task = None
 
 def get_templates():
-    global _templates_cache
-    if _templates_cache is None:
-        _templates_cache = sorted([f for f in os.listdir(config.TEMPLATE_DIR) if f.lower().endswith(('.jpg', '.jpeg', '.png'))])
-    return _templates_cache
+    """Активные шаблоны в порядке галереи (записи индекса: id, name, path, ...)."""
+    return template_index.active()
+
+async def refresh_templates_periodically():
+    while True:
+        await asyncio.sleep(config.TEMPLATE_INDEX_REFRESH_INTERVAL)
+        try:
+            await asyncio.to_thread(template_index.refresh)
+        except Exception as e:
+            logging.error(f"Template index refresh failed: {e}")
+
+# Telegram file_id уже загруженных шаблонов: галерея не загружает файл повторно
+template_file_ids = FileIdIndex(config.TEMPLATE_FILE_ID_INDEX)
 
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 
-async def check_subscription(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+# Результаты проверки подписки: user_id -> bool.
+# "Подписан" живёт дольше, "не подписан" — недолго, чтобы подписка быстро вступала в силу.
+_subscription_cache = LRUCache(config.SUBSCRIPTION_CACHE_SIZE)
+metrics.register_cache("subscription", _subscription_cache.stats)
+
+async def check_subscription(user_id: int, context: ContextTypes.DEFAULT_TYPE, use_cache=True) -> bool:
     """Проверяет, подписан ли пользователь на указанный канал."""
+    if use_cache:
+        cached = _subscription_cache.get(user_id)
+        if cached is not None:
+            return cached
+
     try:
         member = await context.bot.get_chat_member(chat_id=config.CHANNEL_USERNAME, user_id=user_id)
-        # Статусы, указывающие на то, что пользователь является участником канала
-        if member.status in ['member', 'administrator', 'creator']:
-            return True
-        else:
-            return False
     except Exception as e:
+        # Ошибки не кэшируем: это проблема бота, а не пользователя
         logging.error(f"Ошибка при проверке подписки для {user_id} на {config.CHANNEL_USERNAME}: {e}. Возможно, бот не является администратором в канале.")
         return False
 
+    # Статусы, указывающие на то, что пользователь является участником канала
+    subscribed = member.status in ['member', 'administrator', 'creator']
+    ttl = config.SUBSCRIPTION_TTL_POSITIVE if subscribed else config.SUBSCRIPTION_TTL_NEGATIVE
+    _subscription_cache.set(user_id, subscribed, ttl=ttl)
+    return subscribed
+
+def invalidate_subscription(user_id: int):
+    _subscription_cache.pop(user_id)
+
+async def send_subscription_prompt(update: Update):
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("Подписаться на канал", url=f"https://t.me/{config.CHANNEL_USERNAME.lstrip('@')}")],
+        [InlineKeyboardButton("✅ Я подписался", callback_data=config.CALLBACK_CHECK_SUBSCRIPTION)]
+    ])
+    await update.effective_message.reply_text(
+        f"Для использования бота, пожалуйста, подпишитесь на наш канал: {config.CHANNEL_USERNAME}",
+        reply_markup=keyboard,
+        parse_mode='Markdown'
+    )
+
 # --- КЛАВИАТУРЫ ---
 
-def get_gallery_keyboard(current_index, sticker_mode=False):
+def get_gallery_keyboard(template_id, sticker_mode=False):
+    # В callback_data стабильный id шаблона, а не позиция: она меняется при добавлении шаблонов
     select_text = "✅ Выбрать"
     keyboard = [
         [
-            InlineKeyboardButton("⬅️", callback_data=f"{config.CALLBACK_GALLERY_PREV_PREFIX}{current_index}"),
-            InlineKeyboardButton(select_text, callback_data=f"{config.CALLBACK_GALLERY_SELECT_MEME_PREFIX}{current_index}"),
-            InlineKeyboardButton("➡️", callback_data=f"{config.CALLBACK_GALLERY_NEXT_PREFIX}{current_index}"),
+            InlineKeyboardButton("⬅️", callback_data=f"{config.CALLBACK_GALLERY_PREV_PREFIX}{template_id}"),
+            InlineKeyboardButton(select_text, callback_data=f"{config.CALLBACK_GALLERY_SELECT_MEME_PREFIX}{template_id}"),
+            InlineKeyboardButton("➡️", callback_data=f"{config.CALLBACK_GALLERY_NEXT_PREFIX}{template_id}"),
         ],
         [
-            InlineKeyboardButton("🖼 Демотиватор", callback_data=f"{config.CALLBACK_GALLERY_SELECT_DEM_PREFIX}{current_index}")
+            InlineKeyboardButton("🖼 Демотиватор", callback_data=f"{config.CALLBACK_GALLERY_SELECT_DEM_PREFIX}{template_id}")
         ]
     ]
     return InlineKeyboardMarkup(keyboard)
@@ -76,6 +131,33 @@ def get_user_photo_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+# Эффекты по callback_data: (операция, kwargs, эмодзи)
+EFFECTS = {
+    config.CALLBACK_EFFECT_LIQUID: ("liquid", {"scale": 0.5}, "🫠"),
+    config.CALLBACK_EFFECT_DEEPFRY: ("deepfry", {}, "🍟"),
+    config.CALLBACK_EFFECT_WARP: ("warp", {}, "🌀"),
+    config.CALLBACK_EFFECT_CRISPY: ("crispy", {}, "👁️‍🗨️"),
+    config.CALLBACK_EFFECT_BULGE: ("bulge", {}, "👀"),
+    config.CALLBACK_EFFECT_PINCH: ("pinch", {}, "🕳️"),
+}
+
+def get_effects_keyboard(chain):
+    keyboard = [
+        [InlineKeyboardButton("🫠 Жидкий", callback_data=config.CALLBACK_EFFECT_LIQUID)],
+        [InlineKeyboardButton("🍟 Прожарка", callback_data=config.CALLBACK_EFFECT_DEEPFRY)],
+        [InlineKeyboardButton("🌀 Вихрь", callback_data=config.CALLBACK_EFFECT_WARP)],
+        [InlineKeyboardButton("👁️‍🗨️ Криспи", callback_data=config.CALLBACK_EFFECT_CRISPY)],
+        [InlineKeyboardButton("👀 Рыбий глаз", callback_data=config.CALLBACK_EFFECT_BULGE)],
+        [InlineKeyboardButton("🕳️ Дырка", callback_data=config.CALLBACK_EFFECT_PINCH)],
+    ]
+    if chain:
+        keyboard.append([
+            InlineKeyboardButton("▶️ Применить", callback_data=config.CALLBACK_EFFECT_APPLY),
+            InlineKeyboardButton("↩️ Убрать последний", callback_data=config.CALLBACK_EFFECT_UNDO),
+        ])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=config.CALLBACK_BACK_TO_USER_PHOTO)])
+    return InlineKeyboardMarkup(keyboard)
+
 def get_sticker_intermediate_keyboard():
     keyboard = [
         [InlineKeyboardButton("➕ Добавить ещё", callback_data=config.CALLBACK_STICKER_CONTINUE)],
@@ -91,24 +173,202 @@ def get_sticker_final_keyboard(url):
 
 # --- УТИЛИТА ОБРАБОТКИ ФОТО ---
 
-async def process_photo_setup(update: Update, context: ContextTypes.DEFAULT_TYPE, photo_obj):
-    """Универсальная функция: скачивает фото и показывает меню выбора действий."""
-    photo_file = await photo_obj.get_file()
-    file_path = os.path.join(config.USER_UPLOAD_DIR, f"{uuid.uuid4()}.jpg")
-    await photo_file.download_to_drive(file_path)
-    
-    context.user_data['user_template'] = file_path
-    
-    sticker_mode = context.user_data.get('sticker_mode', False)
+async def process_photo_setup(update: Update, context: ContextTypes.DEFAULT_TYPE, photo_sizes):
+    """Запоминает фото (размеры, скачивается позже — см. resolve_user_photo) и показывает меню действий."""
+    context.user_data['user_template'] = list(photo_sizes)
+    context.user_data.pop('effect_chain', None)
+    await update.effective_message.reply_text(photo_menu_text(context), reply_markup=get_user_photo_keyboard())
+    return ConversationHandler.END
+
+def effect_chain_label(chain):
+    return " → ".join(EFFECTS[effect][2] for effect in chain)
+
+def photo_menu_text(context: ContextTypes.DEFAULT_TYPE):
     text = "Фото получено! Что делаем?"
-    if sticker_mode:
+    if context.user_data.get('sticker_mode', False):
         text = "Фото для стикера загружено. Выберите обработку:"
-        
-    await update.effective_message.reply_text(text, reply_markup=get_user_photo_keyboard())
-    return ConversationHandler.END
+    chain = context.user_data.get('effect_chain')
+    if chain:
+        text += f"\nЭффекты: {effect_chain_label(chain)} (наложатся и под текст мема или демотиватора)"
+    return text
+
+def effects_menu_text(chain):
+    if not chain:
+        return f"✨ Выберите эффект. Можно наложить до {config.EFFECT_CHAIN_MAX_LENGTH} подряд."
+    text = f"✨ Эффекты: {effect_chain_label(chain)}"
+    if len(chain) >= config.EFFECT_CHAIN_MAX_LENGTH:
+        text += "\nБольше эффектов не добавить."
+    return text + "\n«Применить» — получить картинку, «Назад» — добавить к ним текст."
+
+def effect_steps(context: ContextTypes.DEFAULT_TYPE, source):
+    """Шаги наложенных эффектов. Только для фото пользователя: шаблоны галереи идут без них."""
+    if not isinstance(source, list):
+        return []
+    steps = []
+    for effect in context.user_data.get('effect_chain', []):
+        operation, kwargs, _ = EFFECTS[effect]
+        steps.append(effect_chain.step(operation, **kwargs))
+    return steps
+
+def template_available(source):
+    """Шаблон — это путь к файлу галереи или фото пользователя (размеры PhotoSize)."""
+    if isinstance(source, str):
+        return os.path.exists(source)
+    return bool(source)
+
+def release_user_photo(context: ContextTypes.DEFAULT_TYPE, source):
+    """Убирает из сессии фото, из которого сделан результат, если пользователь не прислал новое."""
+    if not isinstance(source, list):
+        return
+    if context.user_data.get('template') is source:
+        context.user_data.pop('template', None)
+    if context.user_data.get('user_template') is source:
+        context.user_data.pop('user_template', None)
+        context.user_data.pop('effect_chain', None)
+
+async def resolve_user_photo(photo_sizes, steps, sticker):
+    """Скачивает наименьший PhotoSize, которого хватает цепочке и режиму."""
+    min_side = effect_chain.input_size(steps, sticker)
+    return await upload_cache.fetch(upload_cache.pick_photo_size(photo_sizes, min_side))
+
+async def render_image(source, steps, sticker, user_id=None, on_position=None, replace=True, group=None, max_running=None):
+    """Рендерит цепочку в воркере через очередь render_engine: JPEG, а для стикера — WebP."""
+    return await render_engine.submit(
+        "utils.pipeline:render", (source, steps, sticker),
+        user_id=user_id, group=group, max_running=max_running, cost=effect_chain.cost(steps),
+        replace=replace, on_position=on_position
+    )
+
+def queue_reporter(status, text):
+    """on_position для render_image: показывает место задачи в очереди, а при старте — исходный текст."""
+    async def report(position):
+        if position:
+            await status.update(f"{text}\n⏳ Место в очереди: {position}")
+        else:
+            await status.update(text, force=True)
+    return report
+
+def source_id(source):
+    """Идентификатор содержимого исходника для кэша результатов, или None."""
+    if isinstance(source, Upload):
+        return ("upload", source.unique_id)
+    template = template_index.by_path(source) if isinstance(source, str) else None
+    return ("template", template["sha1"]) if template else None
+
+async def render_cached(source, steps, sticker, **job):
+    """Рендер через кэш результатов; возвращает (байты, ключ кэша или None)."""
+    if isinstance(source, list):
+        source = await resolve_user_photo(source, steps, sticker)
+    content_id = source_id(source)
+    if content_id is None:
+        return await render_image(source, steps, sticker, **job), None
+
+    key = result_cache.result_key(content_id, steps, sticker)
+    image_bytes = result_cache.get(key)
+    if image_bytes is None:
+        image_bytes = await render_image(source, steps, sticker, **job)
+        result_cache.put(key, image_bytes)
+    return image_bytes, key
+
+def sticker_session(context: ContextTypes.DEFAULT_TYPE):
+    """Пак сессии на момент запуска задачи: (имя, название, создан ли), вне режима стикерпака — None."""
+    if not context.user_data.get('sticker_mode'):
+        return None
+    return context.user_data['pack_name'], context.user_data['pack_title'], context.user_data.get('pack_created', False)
+
+def pack_created(context: ContextTypes.DEFAULT_TYPE, pack_name, created):
+    """Создан ли пак: по сессии, а если сессия уже о другом паке — по снимку created."""
+    if context.user_data.get('pack_name') == pack_name:
+        return context.user_data.get('pack_created', False)
+    return created
+
+def mark_pack_created(context: ContextTypes.DEFAULT_TYPE, pack_name):
+    """Отмечает пак созданным, только если он всё ещё пак сессии."""
+    if context.user_data.get('pack_name') == pack_name:
+        context.user_data['pack_created'] = True
+
+class _PackState:
+    """Замок создания пака и флаг «создан», общие для задач этого пака."""
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.created = False
+
+# Живёт, пока пак нужен хоть одной задаче
+_pack_states = weakref.WeakValueDictionary() # имя пака -> _PackState
+
+async def ensure_pack(context: ContextTypes.DEFAULT_TYPE, pack, create):
+    """Создаёт пак через create(), если его ещё нет, и возвращает True; задачи одного пака идут по одной."""
+    pack_name, _, created = pack
+    state = _pack_states.setdefault(pack_name, _PackState())
+    async with state.lock:
+        if state.created or pack_created(context, pack_name, created):
+            return False
+        await create()
+        state.created = True
+        mark_pack_created(context, pack_name)
+        return True
+
+def start_render(update: Update, context: ContextTypes.DEFAULT_TYPE, source, steps, msg, text, handler, error_text):
+    """Запускает рендер и отправку результата фоновой задачей; сессия читается сейчас, а не после рендера."""
+    pack = sticker_session(context)
+    context.application.create_task(
+        _render_and_send(update, context, source, steps, pack, msg, text, handler, error_text), update=update
+    )
+
+async def _render_and_send(update: Update, context: ContextTypes.DEFAULT_TYPE, source, steps, pack, msg, text, handler, error_text):
+    async with metrics.track(handler):
+        status = ProgressMessage(msg, text) # msg.text — то, что было до edit_text
+        try:
+            try:
+                image_bytes, cache_key = await render_cached(
+                    source, steps, pack is not None,
+                    user_id=update.effective_user.id, on_position=queue_reporter(status, text)
+                )
+            finally:
+                status.stop() # Дальше сообщение правит только эта задача
+            await finalize_generation(update, context, image_bytes, msg, cache_key, pack)
+            release_user_photo(context, source)
+        except RenderQueueFull:
+            await msg.edit_text(BUSY_TEXT)
+        except RenderCancelled:
+            # Пользователь уже запустил новую обработку; её состояние не трогаем
+            await msg.edit_text(CANCELLED_TEXT)
+        except Exception as e:
+            logging.error(f"Render error ({handler}): {e}")
+            await msg.edit_text(error_text)
 
 # --- ЛОГИКА ОТОБРАЖЕНИЯ ГАЛЕРЕИ ---
 
+async def _send_gallery_photo(update: Update, context: ContextTypes.DEFAULT_TYPE, photo, caption, keyboard, edit):
+    if edit and update.callback_query:
+        media = InputMediaPhoto(media=photo, caption=caption)
+        return await update.callback_query.edit_message_media(media=media, reply_markup=keyboard)
+    return await context.bot.send_photo(
+        chat_id=update.effective_chat.id,
+        photo=photo,
+        caption=caption,
+        reply_markup=keyboard
+    )
+
+async def send_template_photo(update: Update, context: ContextTypes.DEFAULT_TYPE, template_path, caption, keyboard, edit=False):
+    """Показывает шаблон галереи по сохранённому file_id или загружает файл и запоминает его file_id."""
+    file_id = template_file_ids.get(template_path)
+    if file_id:
+        try:
+            return await _send_gallery_photo(update, context, file_id, caption, keyboard, edit)
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return None
+            logging.warning(f"Cached file_id for {template_path} rejected: {e}")
+            template_file_ids.forget(template_path)
+
+    with open(template_path, 'rb') as f:
+        message = await _send_gallery_photo(update, context, f, caption, keyboard, edit)
+    if isinstance(message, Message) and message.photo:
+        template_file_ids.set(template_path, message.photo[-1].file_id)
+    return message
+
 async def show_gallery(update: Update, context: ContextTypes.DEFAULT_TYPE, edit=False):
     templates = get_templates()
     chat_id = update.effective_chat.id
@@ -126,35 +386,30 @@ async def show_gallery(update: Update, context: ContextTypes.DEFAULT_TYPE, edit=
         current_index = 0
         context.user_data['gallery_index'] = 0
         
-    template_path = os.path.join(config.TEMPLATE_DIR, templates[current_index])
+    template = templates[current_index]
+    template_path = template["path"]
     sticker_mode = context.user_data.get('sticker_mode', False)
     
     if sticker_mode:
-        caption = "🎨 Создание стикерпака\nВыберите шаблон или отправьте своё фото:"
+        caption = (
+            f"🎨 Создание стикерпака · шаблон #{template['id']}\n"
+            "Выберите шаблон или отправьте своё фото. Много сразу: альбом с подписями "
+            "или /pack с номерами шаблонов и текстом, по строке на стикер."
+        )
     else:
         caption = "Выберите шаблон для мема или отправьте своё фото:"
 
-    keyboard = get_gallery_keyboard(current_index, sticker_mode)
+    keyboard = get_gallery_keyboard(template["id"], sticker_mode)
 
     try:
-        if edit and update.callback_query:
-            with open(template_path, 'rb') as f:
-                media = InputMediaPhoto(media=f, caption=caption)
-                await update.callback_query.edit_message_media(media=media, reply_markup=keyboard)
-        else:
-            with open(template_path, 'rb') as f:
-                await context.bot.send_photo(
-                    chat_id=chat_id,
-                    photo=f,
-                    caption=caption,
-                    reply_markup=keyboard
-                )
+        await send_template_photo(update, context, template_path, caption, keyboard, edit)
     except Exception as e:
         logging.error(f"Gallery error: {e}")
         await context.bot.send_message(chat_id=chat_id, text="❌ Ошибка при загрузке изображения.")
 
 # --- ХЕНДЛЕРЫ КОМАНД ---
 
+@metrics.track("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Стартовое меню, обработка реплая на фото, и проверка подписки на канал.
@@ -164,20 +419,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Проверка подписки на канал
     if not await check_subscription(user_id, context):
-        keyboard = InlineKeyboardMarkup([[ 
-            InlineKeyboardButton("Подписаться на канал", url=f"https://t.me/{config.CHANNEL_USERNAME.lstrip('@')}")
-        ]])
-        await update.effective_message.reply_text(
-            f"Для использования бота, пожалуйста, подпишитесь на наш канал: {config.CHANNEL_USERNAME}",
-            reply_markup=keyboard,
-            parse_mode='Markdown'
-        )
+        await send_subscription_prompt(update)
         return ConversationHandler.END # Завершаем диалог, пока пользователь не подпишется
 
     # СЦЕНАРИЙ 1: Пользователь ответил тегом бота на чье-то фото
     if message.reply_to_message and message.reply_to_message.photo:
-        photo = message.reply_to_message.photo[-1]
-        await process_photo_setup(update, context, photo)
+        await process_photo_setup(update, context, message.reply_to_message.photo)
         return ConversationHandler.END
 
     # СЦЕНАРИЙ 2: Обычный запуск (Галерея или Главное меню)
@@ -195,27 +442,26 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return ConversationHandler.END
 
+@metrics.track("photo")
 async def handle_user_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка прямой отправки фото (с подписью или в личке)"""
     user_id = update.effective_user.id
     # Проверка подписки на канал
     if not await check_subscription(user_id, context):
-        keyboard = InlineKeyboardMarkup([[ 
-            InlineKeyboardButton("Подписаться на канал", url=f"https://t.me/{config.CHANNEL_USERNAME.lstrip('@')}")
-        ]])
-        await update.effective_message.reply_text(
-            f"Для использования бота, пожалуйста, подпишитесь на наш канал: {config.CHANNEL_USERNAME}",
-            reply_markup=keyboard,
-            parse_mode='Markdown'
-        )
+        await send_subscription_prompt(update)
+        return ConversationHandler.END
+
+    if update.message.media_group_id and context.user_data.get('sticker_mode'):
+        # Альбом в режиме стикерпака: каждое фото — стикер, подпись — текст мема
+        collect_album_photo(update, context)
         return ConversationHandler.END
 
-    photo = update.message.photo[-1]
-    await process_photo_setup(update, context, photo)
+    await process_photo_setup(update, context, update.message.photo)
     return ConversationHandler.END
 
 # --- HELPER FUNCTIONS FOR button_handler REFACTORING ---
 
+@metrics.track("button:menu")
 async def _handle_menu_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
     query = update.callback_query
     templates = get_templates()
@@ -230,17 +476,22 @@ async def _handle_menu_selection(update: Update, context: ContextTypes.DEFAULT_T
         await query.message.delete()
         await show_gallery(update, context, edit=False)
     elif data == config.CALLBACK_MODE_PACK:
-        context.user_data['sticker_mode'] = True
-        context.user_data['pack_created'] = False
-        user_id = update.effective_user.id
-        bot = await context.bot.get_me()
-        unique_id = str(uuid.uuid4()).replace('-', '')[:8]
-        context.user_data['pack_name'] = f"pack_{user_id}_{unique_id}_by_{bot.username}"
-        context.user_data['pack_title'] = f"DopaMeme Pack {unique_id}"
+        await start_pack_session(update, context)
         await query.message.delete()
         await show_gallery(update, context, edit=False)
     return ConversationHandler.END # End conversation after initial menu selection
 
+async def start_pack_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Включает режим стикерпака с новым, ещё не созданным паком."""
+    context.user_data['sticker_mode'] = True
+    context.user_data['pack_created'] = False
+    user_id = update.effective_user.id
+    bot = await context.bot.get_me()
+    unique_id = str(uuid.uuid4()).replace('-', '')[:8]
+    context.user_data['pack_name'] = f"pack_{user_id}_{unique_id}_by_{bot.username}"
+    context.user_data['pack_title'] = f"DopaMeme Pack {unique_id}"
+
+@metrics.track("button:sticker")
 async def _handle_sticker_flow(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
     query = update.callback_query
     if data == config.CALLBACK_STICKER_CONTINUE:
@@ -262,51 +513,43 @@ async def _handle_sticker_flow(update: Update, context: ContextTypes.DEFAULT_TYP
         return ConversationHandler.END
     return ConversationHandler.END
 
+@metrics.track("button:effects")
 async def _handle_effect_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
     query = update.callback_query
+    chain = context.user_data.setdefault('effect_chain', [])
     if data == config.CALLBACK_USER_SELECT_EFFECTS:
-        keyboard = [
-            [InlineKeyboardButton("🫠 Жидкий", callback_data=config.CALLBACK_EFFECT_LIQUID)],
-            [InlineKeyboardButton("🍟 Прожарка", callback_data=config.CALLBACK_EFFECT_DEEPFRY)],
-            [InlineKeyboardButton("🌀 Вихрь", callback_data=config.CALLBACK_EFFECT_WARP)],
-            [InlineKeyboardButton("👁️‍🗨️ Криспи", callback_data=config.CALLBACK_EFFECT_CRISPY)],
-            [InlineKeyboardButton("👀 Рыбий глаз", callback_data=config.CALLBACK_EFFECT_BULGE)],
-            [InlineKeyboardButton("🕳️ Дырка", callback_data=config.CALLBACK_EFFECT_PINCH)],
-            [InlineKeyboardButton("🔙 Назад", callback_data=config.CALLBACK_BACK_TO_USER_PHOTO)]
-        ]
-        await query.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
-        return # Do not end conversation, user chooses effect
+        await query.message.edit_text(effects_menu_text(chain), reply_markup=get_effects_keyboard(chain))
+        return # Do not end conversation, user chooses effects
     elif data == config.CALLBACK_BACK_TO_USER_PHOTO:
-        await query.message.edit_reply_markup(reply_markup=get_user_photo_keyboard())
+        await query.message.edit_text(photo_menu_text(context), reply_markup=get_user_photo_keyboard())
         return # Do not end conversation, user goes back to photo menu
 
-    if data.startswith("effect_"):
-        if 'user_template' not in context.user_data:
-             await query.message.edit_text("Ошибка: фото потеряно.")
-             return ConversationHandler.END
-        template_path = context.user_data['user_template']
-        effect_map = {
-            config.CALLBACK_EFFECT_LIQUID: (liquid_resize, {"scale": 0.5}, "🫠"),
-            config.CALLBACK_EFFECT_DEEPFRY: (deep_fry_effect, {}, "🍟"),
-            config.CALLBACK_EFFECT_WARP: (warp_effect, {}, "🌀"),
-            config.CALLBACK_EFFECT_CRISPY: (crispy_effect, {}, "👁️‍🗨️"),
-            config.CALLBACK_EFFECT_BULGE: (lens_bulge_effect, {}, "👀"),
-            config.CALLBACK_EFFECT_PINCH: (lens_pinch_effect, {}, "🕳️"),
-        }
-        func, kwargs, emoji = effect_map[data]
-        await query.message.edit_text(f"{emoji} Обрабатываю...", reply_markup=None)
-        msg = query.message
-        try:
-            output_path = func(template_path, **kwargs)
-            await finalize_generation(update, context, output_path, msg)
-            if os.path.exists(template_path): os.remove(template_path)
-            return ConversationHandler.END
-        except Exception as e:
-            logging.error(f"Effect error: {e}")
-            await msg.edit_text("❌ Ошибка при обработке.")
-            return ConversationHandler.END
-    return ConversationHandler.END # Default end, though specific effect handlers usually end it.
+    if 'user_template' not in context.user_data:
+        await query.message.edit_text("Ошибка: фото потеряно.")
+        return ConversationHandler.END
+
+    if data in EFFECTS or data == config.CALLBACK_EFFECT_UNDO:
+        # Эффекты копятся в цепочку и рендерятся вместе: одно декодирование, одно кодирование
+        if data == config.CALLBACK_EFFECT_UNDO:
+            if not chain:
+                return
+            chain.pop()
+        elif len(chain) >= config.EFFECT_CHAIN_MAX_LENGTH:
+            return # Сообщение не изменилось бы, Telegram отклонил бы правку
+        else:
+            chain.append(data)
+        await query.message.edit_text(effects_menu_text(chain), reply_markup=get_effects_keyboard(chain))
+        return # Do not end conversation, user keeps stacking
+
+    if data == config.CALLBACK_EFFECT_APPLY and chain:
+        source = context.user_data['user_template']
+        text = f"{effect_chain_label(chain)} Обрабатываю..."
+        await query.message.edit_text(text, reply_markup=None)
+        start_render(update, context, source, effect_steps(context, source), query.message, text,
+                     "effect_apply", "❌ Ошибка при обработке.")
+    return ConversationHandler.END
 
+@metrics.track("button:user_photo")
 async def _handle_user_photo_action(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
     query = update.callback_query
     if 'user_template' not in context.user_data:
@@ -321,49 +564,69 @@ async def _handle_user_photo_action(update: Update, context: ContextTypes.DEFAUL
         return config.WAITING_DEMOTIVATOR_TEXT
     return ConversationHandler.END
 
+@metrics.track("button:gallery")
 async def _handle_gallery_action(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
     query = update.callback_query
     try:
         parts = data.rsplit('_', 1)
         action_base = parts[0] + "_"
-        index = int(parts[1])
+        template_id = int(parts[1])
     except:
         logging.error(f"Invalid gallery callback data: {data}")
         return ConversationHandler.END 
     
     templates = get_templates()
     if action_base == config.CALLBACK_GALLERY_PREV_PREFIX or action_base == config.CALLBACK_GALLERY_NEXT_PREFIX:
-        new_index = (index - 1) % len(templates) if action_base == config.CALLBACK_GALLERY_PREV_PREFIX else (index + 1) % len(templates)
-        context.user_data['gallery_index'] = new_index
+        position = template_index.position(template_id)
+        if position is None:
+            # Шаблон удалён, пока пользователь листал: продолжаем с его последней позиции
+            position = context.user_data.get('gallery_index', 0)
+        step = -1 if action_base == config.CALLBACK_GALLERY_PREV_PREFIX else 1
+        context.user_data['gallery_index'] = (position + step) % len(templates) if templates else 0
         await show_gallery(update, context, edit=True)
         return # Do not end conversation, user navigates gallery
-    elif action_base == config.CALLBACK_GALLERY_SELECT_MEME_PREFIX:
-        context.user_data['template'] = os.path.join(config.TEMPLATE_DIR, templates[index])
+
+    template = template_index.get(template_id)
+    if template is None:
+        await query.message.edit_caption(caption="Этот шаблон больше недоступен, выберите другой.", reply_markup=None)
+        await show_gallery(update, context, edit=False)
+        return ConversationHandler.END
+    if action_base == config.CALLBACK_GALLERY_SELECT_MEME_PREFIX:
+        context.user_data['template'] = template["path"]
         await query.message.edit_caption(caption="📝 Введите текст для мема (Верх . Низ):", reply_markup=None)
         return config.WAITING_MEME_TEXT
     elif action_base == config.CALLBACK_GALLERY_SELECT_DEM_PREFIX:
-        context.user_data['template'] = os.path.join(config.TEMPLATE_DIR, templates[index])
+        context.user_data['template'] = template["path"]
         await query.message.edit_caption(caption="🖼 Введите текст для демотиватора:", reply_markup=None)
         return config.WAITING_DEMOTIVATOR_TEXT
     return ConversationHandler.END
 
+@metrics.track("button:subscription")
+async def _handle_subscription_recheck(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка "Я подписался": сбрасывает кэш и спрашивает Telegram заново."""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    invalidate_subscription(user_id)
+    if await check_subscription(user_id, context, use_cache=False):
+        await query.answer()
+        await query.message.edit_text("Спасибо за подписку! Нажмите /start, чтобы начать.")
+    else:
+        await query.answer("Подписка пока не найдена.", show_alert=True)
+    return ConversationHandler.END
+
 # --- Refactored button_handler ---
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     data = query.data
+    if data == config.CALLBACK_CHECK_SUBSCRIPTION:
+        # Отвечает на callback сам: алертом, если подписки нет
+        return await _handle_subscription_recheck(update, context)
+    await query.answer()
 
     user_id = update.effective_user.id
     # Subscription check remains here as it's a critical gate for all interactions
     if not await check_subscription(user_id, context):
-        keyboard = InlineKeyboardMarkup([[ 
-            InlineKeyboardButton("Подписаться на канал", url=f"https://t.me/{config.CHANNEL_USERNAME.lstrip('@')}")
-        ]])
-        await update.effective_message.reply_text(
-            f"Для использования бота, пожалуйста, подпишитесь на наш канал: {config.CHANNEL_USERNAME}",
-            reply_markup=keyboard,
-            parse_mode='Markdown'
-        )
+        await send_subscription_prompt(update)
         return ConversationHandler.END
 
     # Route to helper functions based on callback data
@@ -384,92 +647,357 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Fallback for unhandled callback data - should ideally not be reached
     logging.warning(f"Unhandled callback data: {data}")
     return ConversationHandler.END
+def split_meme_text(text):
+    """«Верх . Низ» -> (верх, низ) со схлопнутыми пробелами."""
+    parts = text.split('.', 1)
+    top, bottom = parts[0], parts[1] if len(parts) > 1 else ""
+    return " ".join(top.split()), " ".join(bottom.split())
+
+@metrics.track("generate_meme")
 async def generate_meme_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
-    template_path = context.user_data.get('template')
-    if not template_path or not os.path.exists(template_path):
+    source = context.user_data.get('template')
+    if not template_available(source):
         await update.message.reply_text("Ошибка: шаблон не найден.")
         return ConversationHandler.END
-    parts = text.split('.', 1)
-    top_text = parts[0].strip()
-    bottom_text = parts[1].strip() if len(parts) > 1 else ""
-    msg = await update.message.reply_text("🎨 Рисую...")
-    try:
-        output_path = generate_meme(template_path, top_text, bottom_text)
-        await finalize_generation(update, context, output_path, msg)
-        if "user_uploads" in template_path and os.path.exists(template_path):
-            os.remove(template_path)
-    except Exception as e:
-        logging.error(f"Generate Meme Error: {e}")
-        await msg.edit_text("❌ Ошибка генерации.")
+    top_text, bottom_text = split_meme_text(text)
+    msg = await update.message.reply_text("🎨 Обрабатываю...")
+    steps = effect_steps(context, source) + [effect_chain.step("meme", top_text, bottom_text)]
+    start_render(update, context, source, steps, msg, msg.text, "render:meme", "❌ Ошибка генерации.")
     return ConversationHandler.END
 
+@metrics.track("generate_demotivator")
 async def generate_demotivator_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
-    template_path = context.user_data.get('template')
-    if not template_path or not os.path.exists(template_path):
+    source = context.user_data.get('template')
+    if not template_available(source):
         await update.message.reply_text("Ошибка: шаблон не найден.")
         return ConversationHandler.END
-    msg = await update.message.reply_text("🎨 Рисую...")
-    try:
-        output_path = generate_demotivator(template_path, text)
-        await finalize_generation(update, context, output_path, msg)
-        if "user_uploads" in template_path and os.path.exists(template_path):
-            os.remove(template_path)
-    except Exception as e:
-        logging.error(f"Generate Dem Error: {e}")
-        await msg.edit_text("❌ Ошибка генерации.")
+    msg = await update.message.reply_text("🎨 Обрабатываю...")
+    steps = effect_steps(context, source) + [effect_chain.step("demotivator", text)]
+    start_render(update, context, source, steps, msg, msg.text, "render:demotivator", "❌ Ошибка генерации.")
     return ConversationHandler.END
 
-async def finalize_generation(update: Update, context: ContextTypes.DEFAULT_TYPE, image_path, loading_msg):
+async def send_result_photo(update: Update, image_bytes, cache_key=None):
+    """Отправляет результат; повторы из кэша результатов уходят по file_id без загрузки."""
+    with metrics.stage("upload"):
+        file_id = result_cache.file_id(cache_key) if cache_key else None
+        if file_id:
+            try:
+                return await update.effective_message.reply_photo(file_id)
+            except BadRequest as e:
+                logging.warning(f"Cached result file_id rejected: {e}")
+                result_cache.forget_file_id(cache_key)
+
+        message = await update.effective_message.reply_photo(image_bytes)
+        if cache_key and message.photo:
+            result_cache.remember_file_id(cache_key, message.photo[-1].file_id)
+        return message
+
+async def finalize_generation(update: Update, context: ContextTypes.DEFAULT_TYPE, image_bytes, loading_msg, cache_key=None, pack=None):
+    """pack — sticker_session() на момент запуска рендера: стикер идёт в этот пак, а не в текущий."""
     try:
-        if context.user_data.get('sticker_mode'):
-            sticker_path = prepare_for_sticker(image_path)
-            os.remove(image_path)
+        if pack:
             user_id = update.effective_user.id
-            pack_name = context.user_data['pack_name']
-            pack_title = context.user_data['pack_title']
+            pack_name, pack_title, _ = pack
             try:
-                with open(sticker_path, 'rb') as f:
-                    sticker_input = InputSticker(f, emoji_list=[config.STICKER_EMOJI])
-                    if not context.user_data.get('pack_created'):
-                        await context.bot.create_new_sticker_set(user_id=user_id, name=pack_name, title=pack_title, stickers=[sticker_input], sticker_format=config.STICKER_FORMAT)
-                        context.user_data['pack_created'] = True
-                    else:
+                sticker_input = InputSticker(image_bytes, emoji_list=[config.STICKER_EMOJI])
+                with metrics.stage("upload"):
+                    if not await ensure_pack(context, pack, lambda: context.bot.create_new_sticker_set(
+                            user_id=user_id, name=pack_name, title=pack_title, stickers=[sticker_input], sticker_format=config.STICKER_FORMAT)):
                         await context.bot.add_sticker_to_set(user_id=user_id, name=pack_name, sticker=sticker_input)
-                with open(sticker_path, 'rb') as f:
-                    await loading_msg.delete()
-                    await update.effective_message.reply_document(document=f, caption="✅ Стикер добавлен!", reply_markup=get_sticker_intermediate_keyboard())
+                await loading_msg.delete()
+                await update.effective_message.reply_document(document=image_bytes, filename="sticker.webp", caption="✅ Стикер добавлен!", reply_markup=get_sticker_intermediate_keyboard())
             except Exception as e:
                 logging.error(f"Sticker API Error: {e}")
                 await loading_msg.edit_text(f"❌ Ошибка Telegram: {e}")
-            finally:
-                if os.path.exists(sticker_path): os.remove(sticker_path)
         else:
-            with open(image_path, 'rb') as f:
-                await update.effective_message.reply_photo(f)
+            await send_result_photo(update, image_bytes, cache_key)
             await loading_msg.delete()
-            os.remove(image_path)
     except Exception as e:
         logging.error(f"Finalize Error: {e}")
-        if os.path.exists(image_path): os.remove(image_path)
         await loading_msg.edit_text("❌ Критическая ошибка.")
 
+class MeteredRequest(HTTPXRequest):
+    """HTTP-клиент Bot API, который считает запросы и их время по методам для /metrics."""
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        endpoint = url.rsplit("/", 1)[-1]
+        status = "error"
+        try:
+            with metrics.API_SECONDS.time(method=endpoint):
+                code, payload = await super().do_request(url, method, request_data, **timeouts)
+            status = str(code)
+            return code, payload
+        finally:
+            metrics.API_CALLS.inc(method=endpoint, status=status)
+
+# --- МАССОВАЯ СБОРКА СТИКЕРПАКА ---
+
+class ProgressMessage:
+    """Одно сообщение с прогрессом: правится не чаще раза в PROGRESS_EDIT_INTERVAL секунд, последний текст не теряется."""
+
+    def __init__(self, message: Message, text=None):
+        self.message = message
+        self._text = message.text if text is None else text # То, что сейчас показано
+        self._edited_at = 0.0
+        self._pending = None # (text, reply_markup), ждёт конца интервала
+        self._flush_task = None
+        self._stopped = False
+
+    async def update(self, text, reply_markup=None, force=False):
+        if self._stopped:
+            return
+        wait = self._edited_at + config.PROGRESS_EDIT_INTERVAL - time.monotonic()
+        if text == self._text or force or wait <= 0:
+            self._cancel_flush()
+            if text != self._text:
+                await self._edit(text, reply_markup)
+            return
+        self._pending = (text, reply_markup)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush(wait))
+
+    def stop(self):
+        """Отменяет отложенное и все следующие обновления: сообщение дальше правит кто-то другой."""
+        self._stopped = True
+        self._cancel_flush()
+
+    def _cancel_flush(self):
+        self._pending = None
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+    async def _flush(self, delay):
+        await asyncio.sleep(delay)
+        self._flush_task = None
+        text, reply_markup = self._pending
+        self._pending = None
+        await self._edit(text, reply_markup)
+
+    async def _edit(self, text, reply_markup):
+        self._text = text
+        self._edited_at = time.monotonic()
+        try:
+            await self.message.edit_text(text, reply_markup=reply_markup)
+        except BadRequest as e:
+            logging.warning(f"Progress edit failed: {e}")
+
+async def call_with_flood_wait(method, **kwargs):
+    """Вызов Bot API; на RetryAfter ждёт, сколько просит Telegram, и повторяет."""
+    for _ in range(config.STICKER_FLOOD_RETRIES):
+        try:
+            return await method(**kwargs)
+        except RetryAfter as e:
+            logging.warning(f"Flood limit on {method.__name__}, retrying in {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+    return await method(**kwargs)
+
+async def build_sticker_pack(update: Update, context: ContextTypes.DEFAULT_TYPE, items):
+    """Рисует пачку стикеров items [(исходник, шаги)] и добавляет их в пак сессии по мере готовности."""
+    total = len(items)
+    user_id = update.effective_user.id
+    pack_name, pack_title, created = sticker_session(context)
+    counts = {"rendered": 0, "added": 0}
+    context.user_data['pack_building'] = True
+    try:
+        status = ProgressMessage(await update.effective_message.reply_text(f"🧩 Стикерпак: рисую 0 из {total}..."))
+
+        def progress():
+            return f"🧩 Стикерпак: нарисовано {counts['rendered']} из {total}, добавлено {counts['added']}"
+
+        semaphore = asyncio.Semaphore(config.RENDER_WORKERS)
+
+        async def render(source, steps):
+            try:
+                async with semaphore:
+                    # Пачка идёт своей группой на все воркеры; ни её стикеры, ни новая
+                    # обработка пользователя их не отменяют
+                    image_bytes, _ = await render_cached(
+                        source, steps, True, user_id=user_id, group="pack",
+                        max_running=config.RENDER_WORKERS, replace=False
+                    )
+            except Exception as e:
+                logging.error(f"Bulk sticker render error: {e}")
+                return None
+            counts["rendered"] += 1
+            await status.update(progress())
+            return InputSticker(image_bytes, emoji_list=[config.STICKER_EMOJI])
+
+        async def send(stickers):
+            nonlocal created
+            if not await ensure_pack(context, (pack_name, pack_title, created), lambda: call_with_flood_wait(
+                    context.bot.create_new_sticker_set, user_id=user_id, name=pack_name,
+                    title=pack_title, stickers=stickers, sticker_format=config.STICKER_FORMAT)):
+                # Пак мог создать другой стикер, пока рисовалась первая партия
+                for sticker in stickers:
+                    await asyncio.sleep(config.STICKER_ADD_INTERVAL)
+                    await call_with_flood_wait(context.bot.add_sticker_to_set, user_id=user_id, name=pack_name, sticker=sticker)
+            created = True
+            counts["added"] += len(stickers)
+            await status.update(progress())
+
+        tasks = [asyncio.create_task(render(source, steps)) for source, steps in items]
+        try:
+            pending = tasks
+            if not pack_created(context, pack_name, created):
+                first, pending = tasks[:config.STICKER_SET_INITIAL_MAX], tasks[config.STICKER_SET_INITIAL_MAX:]
+                stickers = [sticker for sticker in await asyncio.gather(*first) if sticker]
+                if stickers:
+                    await send(stickers)
+            for task in pending:
+                sticker = await task
+                if sticker is None:
+                    continue
+                try:
+                    await send([sticker])
+                except TelegramError as e:
+                    logging.error(f"Bulk sticker add error: {e}")
+        except TelegramError as e:
+            logging.error(f"Bulk sticker pack error: {e}")
+            for task in tasks:
+                task.cancel()
+            await status.update(f"❌ Ошибка Telegram: {e}", force=True)
+            return
+    finally:
+        context.user_data.pop('pack_building', None)
+
+    text = f"✅ Добавлено стикеров: {counts['added']} из {total}."
+    if counts["added"] < total:
+        text += " Остальные не получились, попробуйте их ещё раз."
+    await status.update(text, reply_markup=get_sticker_intermediate_keyboard(), force=True)
+
+def sticker_steps(caption):
+    return [effect_chain.step("meme", *split_meme_text(caption))]
+
+# Строка /pack: «12 Верх . Низ» — шаблон с текстом; «12 7 3» или «12, 7, 3» — шаблоны без текста
+_PACK_IDS_LINE = re.compile(r"^#?\d+(?:[\s,]+#?\d+)*$")
+_PACK_TEXT_LINE = re.compile(r"^#?(\d+)[\s.:)\-]+(.*)$")
+
+PACK_USAGE = (
+    "Соберите несколько стикеров за раз: по строке на стикер, номер шаблона "
+    "(он в подписи галереи, #12) и текст мема.\n\n"
+    "/pack\n12 Верх . Низ\n7 Только верх\n3\n\n"
+    "Или отправьте в режиме стикерпака альбом: подписи фото станут текстом."
+)
+
+def parse_pack_request(text):
+    """Разбирает текст /pack в [(id шаблона, текст)]; None, если строка не разобрана."""
+    parts = text.split(maxsplit=1)
+    items = []
+    for line in (parts[1] if len(parts) > 1 else "").splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if _PACK_IDS_LINE.match(line):
+            items.extend((int(n), "") for n in re.findall(r"\d+", line))
+            continue
+        match = _PACK_TEXT_LINE.match(line)
+        if match is None:
+            return None
+        items.append((int(match.group(1)), match.group(2).strip()))
+    return items
+
+@metrics.track("pack")
+async def pack_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/pack: стикеры из шаблонов галереи пачкой (см. PACK_USAGE)."""
+    if not await check_subscription(update.effective_user.id, context):
+        await send_subscription_prompt(update)
+        return
+    requested = parse_pack_request(update.message.text)
+    if not requested:
+        await update.message.reply_text(PACK_USAGE)
+        return
+    if len(requested) > config.STICKER_BULK_MAX:
+        await update.message.reply_text(f"За раз можно добавить до {config.STICKER_BULK_MAX} стикеров.")
+        return
+    missing = [f"#{template_id}" for template_id, _ in requested if template_index.get(template_id) is None]
+    if missing:
+        await update.message.reply_text(f"Нет шаблонов {', '.join(missing)}. Номера — в подписи галереи стикерпака.")
+        return
+    if context.user_data.get('pack_building'):
+        await update.message.reply_text("Подождите, предыдущая пачка ещё собирается.")
+        return
+
+    if not context.user_data.get('sticker_mode') or 'pack_name' not in context.user_data:
+        await start_pack_session(update, context)
+    items = [(template_index.get(template_id)["path"], sticker_steps(caption)) for template_id, caption in requested]
+    # Сборка идёт в фоне: пока она длится, апдейты пользователя не ждут её
+    context.application.create_task(build_sticker_pack(update, context, items), update=update)
+
+# Фото альбома приходят отдельными апдейтами с общим media_group_id:
+# копим их, пока не будет паузы в ALBUM_COLLECT_DELAY секунд
+_albums = {} # media_group_id -> {"photos": [(message_id, размеры фото, подпись)], "task": задача сборки}
+
+def collect_album_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    album = _albums.setdefault(message.media_group_id, {"photos": [], "task": None})
+    album["photos"].append((message.message_id, list(message.photo), message.caption or ""))
+    if album["task"]:
+        album["task"].cancel() # Ещё ждёт: альбом не закончился
+    album["task"] = context.application.create_task(_flush_album(update, context, message.media_group_id), update=update)
+
+async def _flush_album(update: Update, context: ContextTypes.DEFAULT_TYPE, media_group_id):
+    await asyncio.sleep(config.ALBUM_COLLECT_DELAY)
+    photos = sorted(_albums.pop(media_group_id)["photos"], key=lambda photo: photo[0])
+    if len(photos) > config.STICKER_BULK_MAX:
+        await update.message.reply_text(f"За раз можно добавить до {config.STICKER_BULK_MAX} стикеров.")
+        return
+    if context.user_data.get('pack_building'):
+        await update.message.reply_text("Подождите, предыдущая пачка ещё собирается.")
+        return
+    if not context.user_data.get('sticker_mode') or 'pack_name' not in context.user_data:
+        await start_pack_session(update, context) # Пак закончили, пока собирался альбом
+    await build_sticker_pack(update, context, [(sizes, sticker_steps(caption)) for _, sizes, caption in photos])
+
+async def preload_templates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/preload (только для ADMIN_IDS): загружает в Telegram шаблоны, у которых ещё нет file_id."""
+    if update.effective_user.id not in config.ADMIN_IDS:
+        return
+    chat_id = update.effective_chat.id
+    pending = [t["path"] for t in get_templates() if t["path"] not in template_file_ids]
+    status = await update.message.reply_text(f"⏳ Загружаю шаблоны: {len(pending)} из {len(get_templates())}...")
+
+    uploaded = 0
+    for template_path in pending:
+        try:
+            with open(template_path, 'rb') as f:
+                message = await context.bot.send_photo(chat_id=chat_id, photo=f, disable_notification=True)
+            template_file_ids.set(template_path, message.photo[-1].file_id)
+            await message.delete()
+            uploaded += 1
+        except Exception as e:
+            logging.error(f"Preload error for {template_path}: {e}")
+        await asyncio.sleep(config.TEMPLATE_PRELOAD_DELAY)
+
+    await status.edit_text(f"✅ Загружено {uploaded} из {len(pending)}, в кэше {len(template_file_ids)} шаблонов.")
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Отменено. Введите /start.")
     return ConversationHandler.END
 
-def cleanup_temp_files():
-    dirs_to_clean = [config.USER_UPLOAD_DIR, config.GENERATED_DIR]
-    for d in dirs_to_clean:
-        if os.path.exists(d):
-            for f in os.listdir(d):
-                file_path = os.path.join(d, f)
-                try:
-                    if os.path.isfile(file_path):
-                        os.remove(file_path)
-                except Exception as e:
-                    logging.error(f"Error cleaning {file_path}: {e}")
+async def on_startup(application):
+    global _template_refresh_task
+    # Первое сканирование шаблонов: без изменений это только stat файлов
+    await asyncio.to_thread(template_index.refresh)
+    _template_refresh_task = asyncio.create_task(refresh_templates_periodically())
+
+    # Поднимаем воркеры и прогреваем numba. По умолчанию в фоне: бот сразу
+    # принимает апдейты, а первые задачи рендера просто дождутся воркеров.
+    if config.RENDER_WARM_UP_BEFORE_POLLING:
+        await render_engine.start()
+    else:
+        application.create_task(render_engine.start())
+    startup_timing.report_ready()
+
+async def on_first_update(update: object, context: ContextTypes.DEFAULT_TYPE):
+    startup_timing.report_first_update()
+
+async def on_shutdown(application):
+    if _template_refresh_task:
+        _template_refresh_task.cancel()
+    render_engine.shutdown()
 
 if __name__ == '__main__':
     if not config.BOT_TOKEN:
@@ -478,22 +1006,13 @@ if __name__ == '__main__':
     if not config.CHANNEL_USERNAME:
         print("Error: CHANNEL_USERNAME not found in .env or hardcoded. Set CHANNEL_USERNAME for subscription check.")
         exit(1)
-    os.makedirs(config.GENERATED_DIR, exist_ok=True) # Ensure generated directory exists
-    cleanup_temp_files()
-    import threading
-    from http.server import HTTPServer, BaseHTTPRequestHandler
-    class HealthCheck(BaseHTTPRequestHandler):
-        def do_GET(self):
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b"Bot is alive!")
-    def run_web_server():
-        port = int(os.environ.get("PORT", 8080))
-        server = HTTPServer(('0.0.0.0', port), HealthCheck)
-        server.serve_forever()
-    threading.Thread(target=run_web_server, daemon=True).start()
-    
-    application = ApplicationBuilder().token(config.BOT_TOKEN).build()
+    builder = (
+        ApplicationBuilder().token(config.BOT_TOKEN).concurrent_updates(PerUserUpdateProcessor(config.CONCURRENT_UPDATES))
+        .request(MeteredRequest(connection_pool_size=config.BOT_API_CONNECTIONS))
+    )
+    if web_server.webhook_mode():
+        builder = builder.updater(None) # Апдейты приходят в web_server, а не через getUpdates
+    application = builder.post_init(on_startup).post_shutdown(on_shutdown).build()
     
     # ФИЛЬТРЫ ЗАПУСКА
     # start_filter ловит:
@@ -524,6 +1043,10 @@ if __name__ == '__main__':
         fallbacks=[CommandHandler('cancel', cancel), CommandHandler('start', start)]
     )
     
+    application.add_handler(TypeHandler(Update, on_first_update, block=False), group=-1)
     application.add_handler(conv_handler)
+    application.add_handler(CommandHandler('preload', preload_templates))
+    application.add_handler(CommandHandler('pack', pack_command))
     print("Бот запущен!")
-    application.run_polling()
+    # Один event loop: бот (вебхук или polling) и HTTP-сервер с /health и /ready
+    asyncio.run(web_server.run(application))
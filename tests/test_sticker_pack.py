@@ -0,0 +1,49 @@
+import asyncio
+from types import SimpleNamespace
+
+import main
+
+class FakeBot:
+    def __init__(self):
+        self.created = []
+        self.added = []
+
+    async def create_new_sticker_set(self, name, **kwargs):
+        await asyncio.sleep(0.01)
+        if name in self.created:
+            raise RuntimeError("sticker set name is already occupied")
+        self.created.append(name)
+
+    async def add_sticker_to_set(self, name, **kwargs):
+        self.added.append(name)
+
+class FakeMessage:
+    def __init__(self):
+        self.texts = []
+
+    async def edit_text(self, text, reply_markup=None):
+        self.texts.append(text)
+
+    async def delete(self):
+        pass
+
+    async def reply_document(self, **kwargs):
+        pass
+
+def test_concurrent_stickers_create_the_pack_once():
+    bot = FakeBot()
+    context = SimpleNamespace(bot=bot, user_data={
+        'sticker_mode': True, 'pack_name': "pack_1", 'pack_title': "Pack", 'pack_created': False
+    })
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=1), effective_message=FakeMessage())
+    pack = main.sticker_session(context)
+    loading = [FakeMessage(), FakeMessage()]
+
+    async def run():
+        await asyncio.gather(*(main.finalize_generation(update, context, b"webp", msg, pack=pack) for msg in loading))
+    asyncio.run(run())
+
+    assert bot.created == ["pack_1"]
+    assert bot.added == ["pack_1"]
+    assert context.user_data['pack_created']
+    assert all(not msg.texts for msg in loading)
@@ -0,0 +1,87 @@
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    Minimal LRU cache with hit/miss counters, optional per-entry TTL and an
+    optional byte budget (entries are weighed with sizeof(value)).
+    Not thread-safe: each process (and the event loop) owns its own instance.
+    """
+
+    def __init__(self, max_items=None, ttl=None, max_bytes=None, sizeof=None):
+        self.max_items = max_items # None = no limit on the entry count
+        self.ttl = ttl # Default lifetime in seconds, None = never expires
+        self.max_bytes = max_bytes # None = no byte budget
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._data = OrderedDict() # key -> (value, expires_at or None, size)
+
+    def _alive(self, key):
+        expires_at = self._data[key][1]
+        if expires_at is not None and time.monotonic() >= expires_at:
+            self._remove(key)
+            return False
+        return True
+
+    def _remove(self, key):
+        value, _, size = self._data.pop(key)
+        self.bytes -= size
+        return value
+
+    def get(self, key, default=None):
+        if key in self._data and self._alive(key):
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key][0]
+        self.misses += 1
+        return default
+
+    def peek(self, key, default=None):
+        """Like get, but without touching the LRU order or the hit/miss counters."""
+        if key in self._data and self._alive(key):
+            return self._data[key][0]
+        return default
+
+    def set(self, key, value, ttl=None):
+        """Stores value; ttl overrides the cache-wide default for this entry."""
+        if key in self._data:
+            self._remove(key)
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        size = self.sizeof(value) if self.sizeof else 0
+        self._data[key] = (value, expires_at, size)
+        self.bytes += size
+        while self._data and (
+            (self.max_items is not None and len(self._data) > self.max_items)
+            or (self.max_bytes is not None and self.bytes > self.max_bytes)
+        ):
+            self._remove(next(iter(self._data)))
+
+    def pop(self, key, default=None):
+        if key in self._data and self._alive(key):
+            return self._remove(key)
+        return default
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        stats = {
+            "items": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+        if self.max_bytes is not None:
+            stats["bytes"] = self.bytes
+        return stats
+
+    def __contains__(self, key):
+        return key in self._data and self._alive(key)
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,24 @@
+import config
+
+# A render is an ordered list of steps, (operation, args, kwargs), applied to one
+# decoded image and encoded once (see pipeline.render).
+
+def step(operation, *args, **kwargs):
+    return (operation, args, kwargs)
+
+def input_size(steps, sticker=False):
+    """
+    Longest side the chain works at: the smallest working size of its steps
+    (config.OPERATION_INPUT_SIZE), or None if every step takes the full image.
+    Stickers never need more than STICKER_SIZE. The input is resized to it
+    once; each effect's own resize is then a no-op.
+    """
+    sizes = [config.OPERATION_INPUT_SIZE.get(operation) for operation, _, _ in steps]
+    if sticker:
+        sizes.append(config.STICKER_SIZE)
+    sizes = [size for size in sizes if size]
+    return min(sizes) if sizes else None
+
+def cost(steps):
+    """Estimated worker seconds for the chain (config.RENDER_JOB_COST), for queue ordering."""
+    return sum(config.RENDER_JOB_COST.get(operation, 0.0) for operation, _, _ in steps)
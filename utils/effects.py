@@ -1,11 +1,15 @@
 import numpy as np
-from PIL import Image, ImageOps, ImageEnhance
+from PIL import Image, ImageOps
 from scipy.ndimage import convolve
 import os
-import uuid
-from numba import jit
+import time
+import types
+from numba import jit, prange
 import logging
 import config
+from utils.cache import LRUCache
+from utils.render_engine import checkpoint
+from utils import metrics
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -50,11 +54,11 @@ def calc_energy(img_arr):
     
     return np.abs(energy_x) + np.abs(energy_y)
 
-@jit(nopython=True, fastmath=True)
-def find_vertical_seam(energy):
+@jit(nopython=True, fastmath=True, cache=True)
+def _cumulative_energy(energy):
     """
-    Find vertical seam with lowest energy using dynamic programming.
-    Optimized with Numba.
+    Seam-carving DP: minimal cumulative energy per pixel and the parent column
+    each path came from.
     """
     r, c = energy.shape
     m = energy.copy()
@@ -62,23 +66,30 @@ def find_vertical_seam(energy):
 
     for i in range(1, r):
         for j in range(c):
-            # Handle edges
-            if j == 0:
-                idx = np.argmin(m[i-1, j:j+2])
-                offset = j + idx
-                min_energy = m[i-1, offset]
-            elif j == c - 1:
-                idx = np.argmin(m[i-1, j-1:j+1])
-                offset = j - 1 + idx
-                min_energy = m[i-1, offset]
-            else:
-                idx = np.argmin(m[i-1, j-1:j+2])
-                offset = j - 1 + idx
-                min_energy = m[i-1, offset]
+            # Scan the 2-3 parents left to right with strict '<' so ties
+            # resolve to the leftmost one, exactly like np.argmin.
+            offset = j - 1 if j > 0 else 0
+            last = j + 1 if j < c - 1 else c - 1
+            min_energy = m[i-1, offset]
+            for k in range(offset + 1, last + 1):
+                if m[i-1, k] < min_energy:
+                    min_energy = m[i-1, k]
+                    offset = k
             
             backtrack[i, j] = offset
             m[i, j] += min_energy
 
+    return m, backtrack
+
+@jit(nopython=True, fastmath=True, cache=True)
+def find_vertical_seam(energy):
+    """
+    Find vertical seam with lowest energy using dynamic programming.
+    Optimized with Numba.
+    """
+    r, c = energy.shape
+    m, backtrack = _cumulative_energy(energy)
+
     # Backtrack to find the path
     seam = np.zeros(r, dtype=np.int64)
     j = np.argmin(m[-1])
@@ -89,34 +100,180 @@ def find_vertical_seam(energy):
         
     return seam
 
-@jit(nopython=True, fastmath=True)
-def remove_vertical_seam(img_arr, seam):
+@jit(nopython=True, fastmath=True, cache=True)
+def find_vertical_seams_batch(energy, k):
     """
-    Remove the vertical seam from the image.
-    Optimized with Numba (manual loop instead of np.delete).
+    Find up to k non-overlapping low-energy seams from a single DP pass.
+    Paths are backtracked from the cheapest bottom-row endpoints. When the
+    best parent is already taken by a cheaper seam, the path detours through
+    the cheapest free parent; if there is none, the endpoint is skipped.
+    Returns (seams, count), seams has shape (k, rows).
     """
-    r, c, ch = img_arr.shape
-    new_img = np.zeros((r, c - 1, ch), dtype=img_arr.dtype)
-    
+    r, c = energy.shape
+    m, backtrack = _cumulative_energy(energy)
+
+    seams = np.zeros((k, r), dtype=np.int64)
+    taken = np.zeros((r, c), dtype=np.bool_)
+    path = np.zeros(r, dtype=np.int64)
+    count = 0
+
+    for end in np.argsort(m[-1]):
+        j = end
+        path[-1] = j
+        ok = not taken[r-1, j]
+        i = r - 2
+        while ok and i >= 0:
+            parent = backtrack[i+1, j]
+            if taken[i, parent]:
+                parent = -1
+                for p in range(max(0, j - 1), min(c, j + 2)):
+                    if not taken[i, p] and (parent < 0 or m[i, p] < m[i, parent]):
+                        parent = p
+                if parent < 0:
+                    ok = False
+            j = parent
+            path[i] = j
+            i -= 1
+        if not ok:
+            continue
+
+        for i in range(r):
+            taken[i, path[i]] = True
+            seams[count, i] = path[i]
+        count += 1
+        if count == k:
+            break
+
+    return seams, count
+
+@jit(nopython=True, cache=True)
+def _energy_at(gray, i, j, w):
+    """
+    Energy of a single pixel, bit-identical to calc_energy.
+    Uses the same 'reflect' borders and the same summation order as
+    scipy.ndimage.convolve, so no fastmath here.
+    """
+    r = gray.shape[0]
+    im = i - 1 if i > 0 else 0
+    ip = i + 1 if i < r - 1 else r - 1
+    jm = j - 1 if j > 0 else 0
+    jp = j + 1 if j < w - 1 else w - 1
+
+    ex = 0.0
+    ex += gray[im, jm]
+    ex += -gray[im, jp]
+    ex += 2.0 * gray[i, jm]
+    ex += -2.0 * gray[i, jp]
+    ex += gray[ip, jm]
+    ex += -gray[ip, jp]
+
+    ey = 0.0
+    ey += gray[im, jm]
+    ey += 2.0 * gray[im, j]
+    ey += gray[im, jp]
+    ey += -gray[ip, jm]
+    ey += -2.0 * gray[ip, j]
+    ey += -gray[ip, jp]
+
+    return abs(ex) + abs(ey)
+
+@jit(nopython=True, cache=True)
+def remove_vertical_seam_inplace(img_arr, gray, energy, seam, w):
+    """
+    Remove the seam from the first w columns of the working buffers by shifting
+    pixels left, then recompute energy only in the band next to the seam.
+    Columns >= w - 1 are garbage afterwards.
+    """
+    r = img_arr.shape[0]
+
     for i in range(r):
-        skip = seam[i]
-        col_idx = 0
-        for j in range(c):
-            if j == skip:
+        for j in range(seam[i], w - 1):
+            img_arr[i, j, 0] = img_arr[i, j + 1, 0]
+            img_arr[i, j, 1] = img_arr[i, j + 1, 1]
+            img_arr[i, j, 2] = img_arr[i, j + 1, 2]
+            gray[i, j] = gray[i, j + 1]
+            energy[i, j] = energy[i, j + 1]
+
+    w -= 1
+    for i in range(r):
+        lo = seam[i]
+        hi = seam[i]
+        if i > 0:
+            lo = min(lo, seam[i - 1])
+            hi = max(hi, seam[i - 1])
+        if i < r - 1:
+            lo = min(lo, seam[i + 1])
+            hi = max(hi, seam[i + 1])
+        # Outside [lo - 1, hi] the 3x3 neighbourhood is either fully left of
+        # the seam or fully shifted, so the old energy value is still correct.
+        for j in range(max(0, lo - 1), min(w - 1, hi) + 1):
+            energy[i, j] = _energy_at(gray, i, j, w)
+
+@jit(nopython=True, cache=True)
+def remove_vertical_seams_inplace(img_arr, gray, energy, seams, count, w):
+    """
+    Remove `count` non-overlapping seams from the first w columns in one pass,
+    then recompute energy for the remaining w - count columns.
+    """
+    r = img_arr.shape[0]
+    drop = np.zeros(w, dtype=np.bool_)
+
+    for i in range(r):
+        for s in range(count):
+            drop[seams[s, i]] = True
+        dst = 0
+        for j in range(w):
+            if drop[j]:
+                drop[j] = False
                 continue
-            new_img[i, col_idx, 0] = img_arr[i, j, 0]
-            new_img[i, col_idx, 1] = img_arr[i, j, 1]
-            new_img[i, col_idx, 2] = img_arr[i, j, 2]
-            col_idx += 1
-            
-    return new_img
+            if dst != j:
+                img_arr[i, dst, 0] = img_arr[i, j, 0]
+                img_arr[i, dst, 1] = img_arr[i, j, 1]
+                img_arr[i, dst, 2] = img_arr[i, j, 2]
+                gray[i, dst] = gray[i, j]
+            dst += 1
+
+    w -= count
+    for i in range(r):
+        for j in range(w):
+            energy[i, j] = _energy_at(gray, i, j, w)
 
-def liquid_resize(image_path, scale=0.5):
+def _carve_width(img_arr, steps, mode="exact"):
+    """
+    Remove `steps` vertical seams using one working buffer and an energy map
+    that is updated in place. Checks for cancellation after every DP pass.
+    mode="exact": one seam per DP pass, energy recomputed only near the seam.
+    mode="batch": up to LIQUID_RESIZE_BATCH_SEAMS seams per DP pass.
+    """
+    img_arr = np.ascontiguousarray(img_arr)
+    gray = np.mean(img_arr, axis=2)
+    energy = calc_energy(gray)
+    w = img_arr.shape[1]
+
+    if mode == "batch":
+        while steps > 0:
+            k = min(steps, config.LIQUID_RESIZE_BATCH_SEAMS)
+            seams, count = find_vertical_seams_batch(energy[:, :w], k)
+            remove_vertical_seams_inplace(img_arr, gray, energy, seams, count, w)
+            w -= count
+            steps -= count
+            checkpoint()
+    else:
+        for _ in range(steps):
+            seam = find_vertical_seam(energy[:, :w])
+            remove_vertical_seam_inplace(img_arr, gray, energy, seam, w)
+            w -= 1
+            checkpoint()
+
+    return img_arr[:, :w]
+
+def liquid_resize(img, scale=0.5, mode=None):
     """
     Apply liquid resize (seam carving) effect on BOTH axes.
     scale: Target size percentage (e.g. 0.5 = 50% of original width AND height)
+    mode: "exact" or "batch", defaults to config.LIQUID_RESIZE_MODE
     """
-    img = Image.open(image_path).convert("RGB")
+    mode = mode or config.LIQUID_RESIZE_MODE
     
     # 1. Resize for performance (CRITICAL for Render free tier)
     img = resize_image_keep_ratio(img, max_size=config.LIQUID_RESIZE_MAX_SIZE)
@@ -133,10 +290,7 @@ def liquid_resize(image_path, scale=0.5):
         
     logging.info(f"Liquid Resize Phase 1 (Width): removing {steps_w} seams...")
     
-    for _ in range(steps_w):
-        energy = calc_energy(img_arr)
-        seam = find_vertical_seam(energy)
-        img_arr = remove_vertical_seam(img_arr, seam)
+    img_arr = _carve_width(img_arr, steps_w, mode)
         
     # --- PHASE 2: Reduce Height ---
     # Rotate image 90 degrees so we can use the same vertical seam logic
@@ -152,108 +306,308 @@ def liquid_resize(image_path, scale=0.5):
     
     logging.info(f"Liquid Resize Phase 2 (Height): removing {steps_h} seams...")
     
-    for _ in range(steps_h):
-        energy = calc_energy(img_arr)
-        seam = find_vertical_seam(energy)
-        img_arr = remove_vertical_seam(img_arr, seam)
+    img_arr = _carve_width(img_arr, steps_h, mode)
 
     # Rotate back
     img_arr = np.rot90(img_arr, k=-1, axes=(0, 1))
 
-    result_img = Image.fromarray(np.uint8(img_arr))
-        
-    output_path = f"{config.GENERATED_DIR}/{uuid.uuid4()}.jpg"
-    result_img.save(output_path)
-    return output_path
+    return Image.fromarray(np.uint8(img_arr))
+
+# ImageEnhance, fused. Every enhancer is Image.blend(degenerate, image, factor):
+#   Color      degenerate = the image's own L (grey) value per pixel
+#   Contrast   degenerate = mean L of the whole image, a constant
+#   Brightness degenerate = black
+#   Sharpness  degenerate = the image through ImageFilter.SMOOTH
+# The blend only ever sees uint8 pairs, so it becomes a 256x256 table built
+# with Pillow's own float32 arithmetic. With ITU-R 601 L in the same 16-bit
+# fixed point and SMOOTH rounded the same way (outer ring left as is), the
+# output is bit-exact with the ImageEnhance chain, in two passes over uint8
+# buffers instead of three full RGB images per step.
 
-def deep_fry_effect(image_path):
+# SMOOTH (3x3 ones, 5 in the middle, / 13) by the weighted 3x3 sum, rounded
+_SMOOTH_TABLE = ((2 * np.arange(13 * 255 + 1) + 13) // 26).astype(np.uint8)
+_IDENTITY_TABLE = np.arange(256, dtype=np.uint8)
+
+def _blend_table(factor):
+    """
+    Image.blend(degenerate, image, factor) for every uint8 pair, indexed [degenerate, pixel].
+    """
+    degenerate = np.arange(256, dtype=np.float32)[:, None]
+    values = np.arange(256, dtype=np.float32)[None, :]
+    blended = degenerate + np.float32(factor) * (values - degenerate)
+    # Pillow clamps, then truncates
+    return np.clip(blended, 0, 255).astype(np.uint8)
+
+def _contrast_table(histogram, factor):
+    """
+    ImageEnhance.Contrast as a 256-entry table, from the L histogram of the image.
+    """
+    total = int(np.dot(np.arange(256, dtype=np.int64), histogram))
+    mean = int(total / int(histogram.sum()) + 0.5)
+    return _blend_table(factor)[mean]
+
+@jit(nopython=True, cache=True)
+def _noise_saturate(img_arr, noise, blend):
+    """
+    In place: saturating uint8 noise add, then ImageEnhance.Color through blend.
+    Returns the L histogram of the result (for the contrast step).
+    """
+    h, w, _ = img_arr.shape
+    histogram = np.zeros(256, dtype=np.int64)
+
+    for y in range(h):
+        for x in range(w):
+            r = min(np.int64(img_arr[y, x, 0]) + noise[y, x, 0], 255)
+            g = min(np.int64(img_arr[y, x, 1]) + noise[y, x, 1], 255)
+            b = min(np.int64(img_arr[y, x, 2]) + noise[y, x, 2], 255)
+            grey = (r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16
+
+            r = np.int64(blend[grey, r])
+            g = np.int64(blend[grey, g])
+            b = np.int64(blend[grey, b])
+            img_arr[y, x, 0] = r
+            img_arr[y, x, 1] = g
+            img_arr[y, x, 2] = b
+            histogram[(r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16] += 1
+
+    return histogram
+
+@jit(nopython=True, cache=True)
+def _sharpen(img_arr, lut, blend, smooth):
+    """
+    ImageEnhance.Sharpness through blend, of lut[img_arr]: the table (a
+    point-wise step that came before) is applied on the fly. smooth is
+    _SMOOTH_TABLE, passed in rather than as a default: numba cannot cache
+    a kernel with an array default argument.
+    Returns (output, L histogram of the output).
+    """
+    h, w, _ = img_arr.shape
+    output = np.empty((h, w, 3), dtype=np.uint8)
+    histogram = np.zeros(256, dtype=np.int64)
+    # Vertical 3-pixel sums of the current row, so each 3x3 sum is three adds
+    columns = np.empty((w, 3), dtype=np.int64)
+
+    for y in range(h):
+        inner = 0 < y < h - 1
+        for x in range(w):
+            for ch in range(3):
+                value = np.int64(lut[img_arr[y, x, ch]])
+                if inner:
+                    value += lut[img_arr[y - 1, x, ch]] + lut[img_arr[y + 1, x, ch]]
+                columns[x, ch] = value
+
+        for x in range(w):
+            for ch in range(3):
+                center = lut[img_arr[y, x, ch]]
+                if not inner or x == 0 or x == w - 1:
+                    # SMOOTH leaves the outer ring as is, so blending changes nothing
+                    output[y, x, ch] = center
+                else:
+                    total = columns[x - 1, ch] + columns[x, ch] + columns[x + 1, ch] + 4 * np.int64(center)
+                    output[y, x, ch] = blend[smooth[total], center]
+
+            histogram[(np.int64(output[y, x, 0]) * 19595 + np.int64(output[y, x, 1]) * 38470 +
+                       np.int64(output[y, x, 2]) * 7471 + 0x8000) >> 16] += 1
+
+    return output, histogram
+
+def deep_fry_effect(img):
     """
     Apply 'Deep Fried' effect: noise, extreme saturation/contrast, and jpeg artifacts.
+    The artifacts come from the final encode at DEEPFRY_JPEG_QUALITY (see pipeline.py).
+    Same result as noise + ImageEnhance Color, Contrast, Sharpness, in two passes.
     """
-    img = Image.open(image_path).convert("RGB")
-    
     # Resize slightly larger than liquid resize as this is faster
     img = resize_image_keep_ratio(img, max_size=config.EFFECTS_MAX_SIZE_DEEPFRY)
-    
-    # 1. Add Noise
-    # Convert to numpy to add noise efficiently
     img_arr = np.array(img)
     noise = np.random.randint(config.DEEPFRY_NOISE_RANGE[0], config.DEEPFRY_NOISE_RANGE[1], img_arr.shape, dtype='uint8') # Subtle noise
-    # Add noise and clip to valid range
-    img_arr = np.clip(img_arr.astype(int) + noise, 0, 255).astype('uint8')
-    img = Image.fromarray(img_arr)
-    
-    # 2. Enhance Saturation (Fried colors)
-    converter = ImageEnhance.Color(img)
-    img = converter.enhance(config.DEEPFRY_COLOR_ENHANCE_FACTOR) # 3x Saturation
-    
-    # 3. Enhance Contrast (Deep burn)
-    converter = ImageEnhance.Contrast(img)
-    img = converter.enhance(config.DEEPFRY_CONTRAST_ENHANCE_FACTOR) # 2x Contrast
-    
-    # 4. Enhance Sharpness (Crispy edges)
-    converter = ImageEnhance.Sharpness(img)
-    img = converter.enhance(config.DEEPFRY_SHARPNESS_ENHANCE_FACTOR) # 5x Sharpness
-    
-    output_path = f"{config.GENERATED_DIR}/{uuid.uuid4()}.jpg"
-    
-    # 5. Save with low quality for JPEG artifacts
-    img.save(output_path, "JPEG", quality=config.DEEPFRY_JPEG_QUALITY)
-    
-    return output_path
 
-@jit(nopython=True, fastmath=True)
-def apply_swirl_numba(img_arr, radius, strength):
+    # 1. Noise + saturation (fried colors)
+    histogram = _noise_saturate(img_arr, noise, _blend_table(config.DEEPFRY_COLOR_ENHANCE_FACTOR))
+    # 2. Contrast (deep burn), as a table applied inside 3. sharpness (crispy edges)
+    contrast = _contrast_table(histogram, config.DEEPFRY_CONTRAST_ENHANCE_FACTOR)
+    img_arr, _ = _sharpen(img_arr, contrast, _blend_table(config.DEEPFRY_SHARPNESS_ENHANCE_FACTOR), _SMOOTH_TABLE)
+
+    return Image.fromarray(img_arr)
+
+# Remap tables map every output pixel to its source pixel. They depend only on
+# the image size and the effect parameters, so they are built once and reused
+# across requests.
+#   nearest:  int32 (h, w) flat source index, -1 = black
+#   bilinear: float32 (2, h, w) source (y, x), -1 = black
+_remap_cache = LRUCache(config.REMAP_CACHE_SIZE)
+metrics.register_cache("remap", _remap_cache.stats)
+
+def _jit_variants(func):
     """
-    Apply a swirl distortion to the image center using Numba.
+    Compile a kernel twice: serial and row-parallel.
+    Kernels loop over rows with prange, which is a plain range when parallel=False.
+    The parallel copy gets its own name: numba's disk cache is keyed by function
+    name and bytecode, not by compile flags, so the variants would collide.
+    No fastmath: it lets the serial and the parallel loop round differently,
+    and the two variants must produce the same tables and pixels.
     """
-    h, w, c = img_arr.shape
-    cx, cy = w / 2, h / 2
-    output = np.zeros_like(img_arr)
+    parallel_func = types.FunctionType(func.__code__, func.__globals__, func.__name__ + "_parallel",
+                                       func.__defaults__, func.__closure__)
+    parallel_func.__qualname__ = func.__qualname__ + "_parallel"
+    return (jit(nopython=True, cache=True)(func),
+            jit(nopython=True, cache=True, parallel=True)(parallel_func))
 
-    for y in range(h):
+def _remap_nearest(img_arr, src):
+    """
+    Gather pixels through a nearest-neighbour remap table in a single pass.
+    """
+    h, w = src.shape
+    flat = img_arr.reshape(-1, 3)
+    output = np.empty((h, w, 3), dtype=img_arr.dtype)
+
+    for y in prange(h):
         for x in range(w):
-            dx = x - cx
-            dy = y - cy
-            distance = np.sqrt(dx*dx + dy*dy)
+            s = src[y, x]
+            if s < 0:
+                output[y, x, 0] = 0
+                output[y, x, 1] = 0
+                output[y, x, 2] = 0
+            else:
+                output[y, x, 0] = flat[s, 0]
+                output[y, x, 1] = flat[s, 1]
+                output[y, x, 2] = flat[s, 2]
 
-            if distance < radius:
-                # Calculate angle
-                angle = np.arctan2(dy, dx)
-                # Add distortion (more rotation closer to center)
-                distortion = strength * (1.0 - distance / radius)
-                
-                # Calculate source coordinates
-                src_x = cx + distance * np.cos(angle + distortion)
-                src_y = cy + distance * np.sin(angle + distortion)
+    return output
+
+def _remap_bilinear(img_arr, coords):
+    """
+    Sample pixels at float source coordinates with bilinear interpolation.
+    """
+    h, w = coords.shape[1], coords.shape[2]
+    ih, iw = img_arr.shape[0], img_arr.shape[1]
+    output = np.empty((h, w, 3), dtype=img_arr.dtype)
+
+    for y in prange(h):
+        for x in range(w):
+            sy = coords[0, y, x]
+            sx = coords[1, y, x]
+            if sx < 0:
+                output[y, x, 0] = 0
+                output[y, x, 1] = 0
+                output[y, x, 2] = 0
+                continue
+
+            # Coordinates are already clamped to [0, size - 1]
+            x0 = int(sx)
+            y0 = int(sy)
+            x1 = min(x0 + 1, iw - 1)
+            y1 = min(y0 + 1, ih - 1)
+            fx = sx - x0
+            fy = sy - y0
+            w00 = (1.0 - fx) * (1.0 - fy)
+            w01 = fx * (1.0 - fy)
+            w10 = (1.0 - fx) * fy
+            w11 = fx * fy
+
+            for ch in range(3):
+                value = (img_arr[y0, x0, ch] * w00 + img_arr[y0, x1, ch] * w01 +
+                         img_arr[y1, x0, ch] * w10 + img_arr[y1, x1, ch] * w11)
+                output[y, x, ch] = np.uint8(value + 0.5)
+
+    return output
+
+remap_numba, remap_numba_parallel = _jit_variants(_remap_nearest)
+remap_bilinear_numba, remap_bilinear_numba_parallel = _jit_variants(_remap_bilinear)
+
+_SAMPLERS = {
+    "nearest": (remap_numba, remap_numba_parallel),
+    "bilinear": (remap_bilinear_numba, remap_bilinear_numba_parallel),
+}
 
+def _apply_distortion(img_arr, name, params, sampling="nearest", parallel=False):
+    """
+    Apply a cached distortion to img_arr.
+    name: key into _DISTORTION_BUILDERS ("swirl" or "lens"), params: its arguments.
+    """
+    h, w, _ = img_arr.shape
+    key = (name, sampling, h, w) + params
+    table = _remap_cache.get(key)
+    if table is None:
+        builder = _DISTORTION_BUILDERS[(name, sampling)][parallel]
+        table = builder(h, w, *params)
+        _remap_cache.set(key, table)
+    return _SAMPLERS[sampling][parallel](img_arr, table)
+
+@jit(nopython=True, fastmath=True, cache=True)
+def _swirl_source(x, y, cx, cy, radius, strength):
+    """
+    Source coordinates for output pixel (x, y) of a swirl around (cx, cy).
+    Returns (src_x, src_y, inside) where inside is False outside the radius.
+    """
+    dx = x - cx
+    dy = y - cy
+    distance = np.sqrt(dx*dx + dy*dy)
+
+    if distance < radius:
+        # Calculate angle
+        angle = np.arctan2(dy, dx)
+        # Add distortion (more rotation closer to center)
+        distortion = strength * (1.0 - distance / radius)
+        
+        # Calculate source coordinates
+        src_x = cx + distance * np.cos(angle + distortion)
+        src_y = cy + distance * np.sin(angle + distortion)
+        return src_x, src_y, True
+
+    return 0.0, 0.0, False
+
+def _build_swirl_map(h, w, radius, strength):
+    """
+    Remap table for a swirl distortion around the image center.
+    """
+    cx, cy = w / 2, h / 2
+    src = np.empty((h, w), dtype=np.int32)
+
+    for y in prange(h):
+        for x in range(w):
+            # Outside radius (or out of bounds), keep original
+            src[y, x] = y * w + x
+
+            src_x, src_y, inside = _swirl_source(x, y, cx, cy, radius, strength)
+            if inside:
                 # Nearest neighbor interpolation
                 sx = int(round(src_x))
                 sy = int(round(src_y))
 
                 # Boundary checks
                 if 0 <= sx < w and 0 <= sy < h:
-                    output[y, x, 0] = img_arr[sy, sx, 0]
-                    output[y, x, 1] = img_arr[sy, sx, 1]
-                    output[y, x, 2] = img_arr[sy, sx, 2]
-                else:
-                    output[y, x, 0] = img_arr[y, x, 0]
-                    output[y, x, 1] = img_arr[y, x, 1]
-                    output[y, x, 2] = img_arr[y, x, 2]
-            else:
-                # Outside radius, keep original
-                output[y, x, 0] = img_arr[y, x, 0]
-                output[y, x, 1] = img_arr[y, x, 1]
-                output[y, x, 2] = img_arr[y, x, 2]
+                    src[y, x] = sy * w + sx
                 
-    return output
+    return src
 
-def warp_effect(image_path):
+def _build_swirl_coords(h, w, radius, strength):
+    """
+    Same mapping as _build_swirl_map, as float coordinates for bilinear sampling.
+    """
+    cx, cy = w / 2, h / 2
+    coords = np.empty((2, h, w), dtype=np.float32)
+
+    for y in prange(h):
+        for x in range(w):
+            coords[0, y, x] = y
+            coords[1, y, x] = x
+
+            src_x, src_y, inside = _swirl_source(x, y, cx, cy, radius, strength)
+            # Same bounds as nearest sampling (the rounded pixel must exist)
+            if inside and -0.5 <= src_x < w - 0.5 and -0.5 <= src_y < h - 0.5:
+                coords[0, y, x] = min(max(src_y, 0.0), h - 1.0)
+                coords[1, y, x] = min(max(src_x, 0.0), w - 1.0)
+
+    return coords
+
+build_swirl_map_numba, build_swirl_map_numba_parallel = _jit_variants(_build_swirl_map)
+build_swirl_coords_numba, build_swirl_coords_numba_parallel = _jit_variants(_build_swirl_coords)
+
+def warp_effect(img):
     """
     Apply a 'Swirl' warp effect to the center of the image.
     """
-    img = Image.open(image_path).convert("RGB")
-    
     # Resize for consistent speed
     img = resize_image_keep_ratio(img, max_size=config.EFFECTS_MAX_SIZE_DEFAULT)
     img_arr = np.array(img)
@@ -266,30 +620,23 @@ def warp_effect(image_path):
     
     logging.info(f"Applying Swirl Warp: {w}x{h}...")
     
-    # Numba magic
-    result_arr = apply_swirl_numba(img_arr, radius, strength)
+    result_arr = _apply_distortion(img_arr, "swirl", (radius, strength), config.WARP_SAMPLING, config.WARP_PARALLEL)
     
-    result_img = Image.fromarray(result_arr)
-        
-    output_path = f"{config.GENERATED_DIR}/{uuid.uuid4()}.jpg"
-    result_img.save(output_path)
-    return output_path
+    return Image.fromarray(result_arr)
 
-@jit(nopython=True, fastmath=True)
-def apply_lens_numba(img_arr, k):
+def _build_lens_map(h, w, k):
     """
-    Apply radial lens distortion (Barrel/Bulge or Pincushion/Pinch).
+    Remap table for radial lens distortion (Barrel/Bulge or Pincushion/Pinch).
     k < 0: Bulge (Fisheye)
     k > 0: Pinch (Hole)
     """
-    h, w, c = img_arr.shape
     cx, cy = w / 2, h / 2
-    output = np.zeros_like(img_arr)
+    src = np.empty((h, w), dtype=np.int32)
     
     # Normalize radius by the smaller dimension to keep the effect circular
     radius_norm = min(w, h) / 2
 
-    for y in range(h):
+    for y in prange(h):
         for x in range(w):
             dx = x - cx
             dy = y - cy
@@ -310,71 +657,147 @@ def apply_lens_numba(img_arr, k):
             sy = int(round(src_y))
 
             if 0 <= sx < w and 0 <= sy < h:
-                output[y, x, 0] = img_arr[sy, sx, 0]
-                output[y, x, 1] = img_arr[sy, sx, 1]
-                output[y, x, 2] = img_arr[sy, sx, 2]
+                src[y, x] = sy * w + sx
             else:
                 # Black background for out of bounds
-                output[y, x, 0] = 0
-                output[y, x, 1] = 0
-                output[y, x, 2] = 0
+                src[y, x] = -1
 
-    return output
+    return src
+
+def _build_lens_coords(h, w, k):
+    """
+    Same mapping as _build_lens_map, as float coordinates for bilinear sampling.
+    """
+    cx, cy = w / 2, h / 2
+    coords = np.empty((2, h, w), dtype=np.float32)
+    radius_norm = min(w, h) / 2
+
+    for y in prange(h):
+        for x in range(w):
+            dx = x - cx
+            dy = y - cy
+            r = np.sqrt(dx*dx + dy*dy) / radius_norm
+            factor = 1.0 + k * (r * r)
+            
+            src_x = cx + dx * factor
+            src_y = cy + dy * factor
+
+            if -0.5 <= src_x < w - 0.5 and -0.5 <= src_y < h - 0.5:
+                coords[0, y, x] = min(max(src_y, 0.0), h - 1.0)
+                coords[1, y, x] = min(max(src_x, 0.0), w - 1.0)
+            else:
+                coords[0, y, x] = -1.0
+                coords[1, y, x] = -1.0
+
+    return coords
+
+build_lens_map_numba, build_lens_map_numba_parallel = _jit_variants(_build_lens_map)
+build_lens_coords_numba, build_lens_coords_numba_parallel = _jit_variants(_build_lens_coords)
 
-def lens_bulge_effect(image_path):
+_DISTORTION_BUILDERS = {
+    ("swirl", "nearest"): (build_swirl_map_numba, build_swirl_map_numba_parallel),
+    ("swirl", "bilinear"): (build_swirl_coords_numba, build_swirl_coords_numba_parallel),
+    ("lens", "nearest"): (build_lens_map_numba, build_lens_map_numba_parallel),
+    ("lens", "bilinear"): (build_lens_coords_numba, build_lens_coords_numba_parallel),
+}
+
+def lens_bulge_effect(img):
     """
     Apply Fisheye/Bulge effect (towards the viewer).
     """
-    img = Image.open(image_path).convert("RGB")
     img = resize_image_keep_ratio(img, max_size=config.EFFECTS_MAX_SIZE_DEFAULT)
     img_arr = np.array(img)
     
     # k < 0 expands the center
-    result_arr = apply_lens_numba(img_arr, k=config.BULGE_K_VALUE)
+    result_arr = _apply_distortion(img_arr, "lens", (config.BULGE_K_VALUE,), config.BULGE_SAMPLING, config.BULGE_PARALLEL)
     
-    result_img = Image.fromarray(result_arr)
-    output_path = f"{config.GENERATED_DIR}/{uuid.uuid4()}.jpg"
-    result_img.save(output_path)
-    return output_path
+    return Image.fromarray(result_arr)
 
-def lens_pinch_effect(image_path):
+def lens_pinch_effect(img):
     """
     Apply Pinch/Hole effect (away from the viewer).
     """
-    img = Image.open(image_path).convert("RGB")
     img = resize_image_keep_ratio(img, max_size=config.EFFECTS_MAX_SIZE_DEFAULT)
     img_arr = np.array(img)
     
     # k > 0 shrinks the center (tunnel)
-    result_arr = apply_lens_numba(img_arr, k=config.PINCH_K_VALUE)
+    result_arr = _apply_distortion(img_arr, "lens", (config.PINCH_K_VALUE,), config.PINCH_SAMPLING, config.PINCH_PARALLEL)
     
-    result_img = Image.fromarray(result_arr)
-    output_path = f"{config.GENERATED_DIR}/{uuid.uuid4()}.jpg"
-    result_img.save(output_path)
-    return output_path
+    return Image.fromarray(result_arr)
 
-def crispy_effect(image_path):
+def crispy_effect(img):
     """
     Apply 'Crispy' effect: extreme sharpness, high contrast, and increased brightness.
+    Same result as ImageEnhance Sharpness, Contrast, Brightness, in two passes.
     """
-    img = Image.open(image_path).convert("RGB")
-    
     # Resize for consistent speed
     img = resize_image_keep_ratio(img, max_size=config.EFFECTS_MAX_SIZE_CRISPY)
-    
-    # 1. Enhance Sharpness (Extreme!)
-    converter = ImageEnhance.Sharpness(img)
-    img = converter.enhance(config.CRISPY_SHARPNESS_ENHANCE_FACTOR) # Very high sharpness
-    
-    # 2. Enhance Contrast (Blow out blacks and whites)
-    converter = ImageEnhance.Contrast(img)
-    img = converter.enhance(config.CRISPY_CONTRAST_ENHANCE_FACTOR) # Very high contrast
-    
-    # 3. Enhance Brightness (Makes it more "blown out")
-    converter = ImageEnhance.Brightness(img)
-    img = converter.enhance(config.CRISPY_BRIGHTNESS_ENHANCE_FACTOR) # A bit brighter
-    
-    output_path = f"{config.GENERATED_DIR}/{uuid.uuid4()}.jpg"
-    img.save(output_path) # No low JPEG quality here, as it's not deep fry
-    
-    return output_path
+
+    # 1. Sharpness (extreme!)
+    img_arr, histogram = _sharpen(np.asarray(img), _IDENTITY_TABLE, _blend_table(config.CRISPY_SHARPNESS_ENHANCE_FACTOR), _SMOOTH_TABLE)
+
+    # 2. Contrast (blow out blacks and whites) and 3. brightness (more "blown out"), as one table
+    contrast = _contrast_table(histogram, config.CRISPY_CONTRAST_ENHANCE_FACTOR)
+    brightness = _blend_table(config.CRISPY_BRIGHTNESS_ENHANCE_FACTOR)[0]
+
+    return Image.fromarray(brightness[contrast][img_arr])
+
+def _kernel_calls():
+    """
+    One call per numba kernel signature used in production.
+    Array layout matters: energy[:, :w] is a different signature from energy.
+    """
+    img = np.zeros((8, 8, 3), dtype=np.uint8)
+    gray = np.zeros((8, 8))
+    energy = np.zeros((8, 8))
+    seam = np.zeros(8, dtype=np.int64)
+    seams = np.zeros((2, 8), dtype=np.int64)
+    src = np.zeros((8, 8), dtype=np.int32)
+    coords = np.zeros((2, 8, 8), dtype=np.float32)
+    pixels = np.asarray(Image.fromarray(img)) # read-only, as crispy_effect gets it
+    blend = _blend_table(1.0)
+
+    calls = [
+        (find_vertical_seam, (energy,)),
+        (find_vertical_seam, (energy[:, :7],)),
+        (find_vertical_seams_batch, (energy, 2)),
+        (find_vertical_seams_batch, (energy[:, :7], 2)),
+        (remove_vertical_seam_inplace, (img, gray, energy, seam, 8)),
+        (remove_vertical_seams_inplace, (img, gray, energy, seams, 1, 8)),
+        (_noise_saturate, (img.copy(), img, blend)),
+        (_sharpen, (img, _IDENTITY_TABLE, blend, _SMOOTH_TABLE)),
+        (_sharpen, (pixels, _IDENTITY_TABLE, blend, _SMOOTH_TABLE)),
+    ]
+    for kernel in _SAMPLERS["nearest"]:
+        calls.append((kernel, (img, src)))
+    for kernel in _SAMPLERS["bilinear"]:
+        calls.append((kernel, (img, coords)))
+    for (name, _), builders in _DISTORTION_BUILDERS.items():
+        params = (3.0, config.WARP_STRENGTH) if name == "swirl" else (config.BULGE_K_VALUE,)
+        for kernel in builders:
+            calls.append((kernel, (8, 8) + params))
+    return calls
+
+def warm_up():
+    """
+    Compile every numba kernel (or load it from the on-disk cache) before the
+    first request, logging how long each one took.
+    """
+    total_start = time.perf_counter()
+    for kernel, args in _kernel_calls():
+        hits = sum(kernel.stats.cache_hits.values())
+        misses = sum(kernel.stats.cache_misses.values())
+
+        start = time.perf_counter()
+        kernel(*args)
+        elapsed = (time.perf_counter() - start) * 1000
+
+        if sum(kernel.stats.cache_misses.values()) > misses:
+            source = "compiled"
+        elif sum(kernel.stats.cache_hits.values()) > hits:
+            source = "loaded from cache"
+        else:
+            continue
+        logging.info(f"numba {kernel.py_func.__qualname__}: {source} in {elapsed:.0f} ms")
+
+    logging.info(f"numba warm-up done in {time.perf_counter() - total_start:.2f}s")
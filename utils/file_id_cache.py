@@ -0,0 +1,73 @@
+import json
+import logging
+import os
+from utils.files import sha1, write_json
+
+class FileIdIndex:
+    """
+    Persistent local file -> Telegram file_id index, stored as JSON.
+
+    Every entry remembers the file's size, mtime and sha1. A cheap stat check
+    runs on each lookup; only when it no longer matches is the file re-hashed,
+    so a touched-but-identical file keeps its file_id and an edited one drops it.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self._entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"file_id index {self.index_path} unreadable, starting empty: {e}")
+            return {}
+
+    def _save(self):
+        write_json(self.index_path, self._entries, sort_keys=True)
+
+    def get(self, path):
+        """Returns the cached file_id, or None if missing or the file has changed."""
+        entry = self._entries.get(path)
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.forget(path)
+            return None
+
+        if entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["file_id"]
+        if entry["size"] == stat.st_size and entry["sha1"] == sha1(path):
+            # Same content with a new mtime (e.g. a fresh checkout): keep the file_id
+            entry["mtime_ns"] = stat.st_mtime_ns
+            self._save()
+            return entry["file_id"]
+
+        logging.info(f"{path} changed, dropping its cached file_id")
+        self.forget(path)
+        return None
+
+    def set(self, path, file_id):
+        stat = os.stat(path)
+        self._entries[path] = {
+            "file_id": file_id,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha1": sha1(path),
+        }
+        self._save()
+
+    def forget(self, path):
+        if self._entries.pop(path, None) is not None:
+            self._save()
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def __len__(self):
+        return len(self._entries)
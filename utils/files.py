@@ -0,0 +1,55 @@
+import hashlib
+import json
+import os
+import struct
+
+# File helpers shared by the persistent indexes (file_id_cache.py, template_index.py).
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# JPEG start-of-frame markers: SOF0-SOF15 except DHT, JPG and DAC
+_JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+def sha1(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write_json(path, data, **options):
+    """Writes data as JSON through a temporary file, so readers never see half a file."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=1, **options)
+    os.replace(tmp_path, path)
+
+def _jpeg_size(f):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        # Markers may be padded with any number of 0xFF bytes
+        while len(marker) == 2 and marker[0] == 0xFF and marker[1] == 0xFF:
+            marker = marker[1:] + f.read(1)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            raise ValueError("JPEG without a frame header")
+        if 0xD0 <= marker[1] <= 0xD7 or marker[1] == 0x01:
+            continue # Standalone markers carry no length
+        length = struct.unpack(">H", f.read(2))[0]
+        if marker[1] in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">xHH", f.read(5))
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+
+def image_size(path):
+    """(width, height) of a JPEG or PNG, read from its header like PIL's Image.size."""
+    with open(path, "rb") as f:
+        head = f.read(24)
+        if head.startswith(PNG_SIGNATURE) and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+        if head.startswith(b"\xff\xd8"):
+            return _jpeg_size(f)
+    raise ValueError(f"{path} is neither JPEG nor PNG")
@@ -1,8 +1,10 @@
 from PIL import Image, ImageDraw, ImageFont, ImageOps
 import os
-import uuid
+import math
 import logging
 import config
+from utils.cache import LRUCache
+from utils import metrics
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -31,91 +33,210 @@ def get_font(size, font_name="Arial"):
     _loaded_fonts[font_key] = font
     return font
 
+class _GlyphTable:
+    """
+    Width lookups for one font at one size, used by wrap_text.
+
+    A line's bbox width is the ink/advance extent of its words laid out with
+    spaces and kerning. Each word is measured once (advance + bbox), and the
+    space advance and kerning pairs are looked up from tables, so growing a
+    line by one word costs O(1) instead of re-measuring the whole line.
+    Estimates are within a pixel of textbbox; wrap_text confirms near-limit
+    cases with textbbox so line breaks are exactly as before.
+    """
+
+    def __init__(self, font):
+        self.font = font
+        self.space = font.getlength(" ")
+        self._kerning = LRUCache(config.WRAP_KERNING_CACHE_SIZE)
+        self._words = LRUCache(config.WRAP_WORD_CACHE_SIZE)
+        self._advances = {}
+
+    def advance(self, char):
+        adv = self._advances.get(char)
+        if adv is None:
+            adv = self._advances[char] = self.font.getlength(char)
+        return adv
+
+    def kerning(self, left, right):
+        pair = left + right
+        kern = self._kerning.get(pair)
+        if kern is None:
+            kern = self.font.getlength(pair) - self.advance(left) - self.advance(right)
+            self._kerning.set(pair, kern)
+        return kern
+
+    def word(self, word):
+        """Returns (advance, ink left, ink right) of a single word."""
+        metrics = self._words.get(word)
+        if metrics is None:
+            bbox = self.font.getbbox(word)
+            metrics = (self.font.getlength(word), bbox[0], bbox[2])
+            self._words.set(word, metrics)
+        return metrics
+
+    def gap(self, left_word, right_word):
+        """Pen advance of the space between two words, kerning included."""
+        return self.kerning(left_word[-1], " ") + self.space + self.kerning(" ", right_word[0])
+
+_glyph_tables = {}
+
+def _glyph_table(font):
+    table = _glyph_tables.get(font)
+    if table is None:
+        table = _glyph_tables[font] = _GlyphTable(font)
+    return table
+
+# wrap_text double-checks with textbbox when the estimate is this close to max_width
+_WRAP_EXACT_MARGIN = 2
+
 def wrap_text(text, font, max_width, draw):
+    table = _glyph_table(font)
     lines = []
     words = text.split()
     current_line = []
+    # Layout of current_line: pen position after its last word, ink extent
+    line_left = line_right = pen = 0
     
     for word in words:
         test_line = current_line + [word]
-        bbox = draw.textbbox((0, 0), " ".join(test_line), font=font)
-        w = bbox[2] - bbox[0]
+        advance, left, right = table.word(word)
+        if current_line:
+            start = pen + table.gap(current_line[-1], word)
+            test_left = line_left
+            test_right = max(line_right, start + right)
+        else:
+            start = 0
+            test_left, test_right = min(0, left), right
+        w = test_right - test_left
+        if abs(w - max_width) <= _WRAP_EXACT_MARGIN:
+            bbox = draw.textbbox((0, 0), " ".join(test_line), font=font)
+            w = bbox[2] - bbox[0]
+
         if w > max_width:
             if len(current_line) > 0:
                 lines.append(" ".join(current_line))
                 current_line = [word]
+                line_left, line_right, pen = min(0, left), right, advance
             else:
                 # Слово длиннее ширины, придется писать как есть
                 lines.append(word)
                 current_line = []
         else:
             current_line = test_line
+            line_left, line_right, pen = test_left, test_right, start + advance
             
     if current_line:
         lines.append(" ".join(current_line))
     return lines
 
+# Wrapped lines and their measurements: (text, font name, size, max width) -> layout.
+# The same captions come up again and again, and measuring is the slow part.
+_layout_cache = LRUCache(config.TEXT_LAYOUT_CACHE_SIZE)
+_measure_draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+metrics.register_cache("text_layout", _layout_cache.stats)
+
+def layout_text(text, font_name, size, max_width):
+    """
+    Wraps text to max_width and measures every line.
+    Returns (lines, widths, heights), where heights are bbox heights.
+    """
+    key = (text, font_name, size, max_width)
+    layout = _layout_cache.get(key)
+    if layout is None:
+        font = get_font(size, font_name)
+        lines = wrap_text(text, font, max_width, _measure_draw)
+        widths, heights = [], []
+        for line in lines:
+            bbox = _measure_draw.textbbox((0, 0), line, font=font)
+            widths.append(bbox[2] - bbox[0])
+            heights.append(bbox[3] - bbox[1])
+        layout = (tuple(lines), tuple(widths), tuple(heights))
+        _layout_cache.set(key, layout)
+    return layout
+
+# Watermark sprites by font size: (sprite, offset from the text origin, text height, margin)
+_watermark_cache = LRUCache(config.WATERMARK_SPRITE_CACHE_SIZE)
+metrics.register_cache("watermark", _watermark_cache.stats)
+
+def _watermark_sprite(font_size):
+    """
+    Renders the watermark once per font size onto a transparent sprite that
+    only covers the text and its outline.
+    """
+    sprite = _watermark_cache.get(font_size)
+    if sprite is not None:
+        return sprite
+
+    font = get_font(font_size, config.MEME_FONT_NAME) # Using MEME_FONT_NAME for watermark for now
+    text = config.WATERMARK_TEXT
+    d = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+    
+    # Get text size
+    bbox = d.textbbox((0, 0), text, font=font)
+    text_h = bbox[3] - bbox[1]
+    margin = max(10, int(font_size / 2))
+    # Dynamic outline width (proportional to font size)
+    outline_width = max(1, int(font_size // config.WATERMARK_OUTLINE_WIDTH_FACTOR))
+
+    # The y position is half-pixel aligned for odd margins. Draw at a positive
+    # origin with the same sub-pixel offset so the sprite rasterizes exactly
+    # like text drawn in place, then crop it to the visible pixels.
+    frac_y = (margin * 1.5) % 1
+    pad = font_size + outline_width
+    right, bottom = d.textbbox((pad, pad), text, font=font, stroke_width=outline_width)[2:]
+    layer = Image.new('RGBA', (right + pad, bottom + pad), (255, 255, 255, 0))
+    
+    # White text with a black outline (both 60% opacity), drawn in one pass
+    ImageDraw.Draw(layer).text(
+        (pad, pad + frac_y), text, font=font,
+        fill=(255, 255, 255, config.WATERMARK_ALPHA),
+        stroke_width=outline_width,
+        stroke_fill=(0, 0, 0, config.WATERMARK_ALPHA)
+    )
+    left, top, right, bottom = layer.getbbox()
+    sprite = (layer.crop((left, top, right, bottom)), (left - pad, top - pad), text_h, margin)
+    _watermark_cache.set(font_size, sprite)
+    return sprite
+
 def add_watermark(img):
     """Adds a semi-transparent watermark @dopamemerobot to the bottom-left."""
+    with metrics.stage("watermark"):
+        return _add_watermark(img)
+
+def _add_watermark(img):
     try:
-        # Create a drawing context for the watermark
-        # Use RGBA for transparency
-        if img.mode != 'RGBA':
-            img = img.convert("RGBA")
-            
+        if img.mode != 'RGB':
+            img = img.convert("RGB")
         width, height = img.size
-        txt = Image.new('RGBA', img.size, (255,255,255,0))
-        d = ImageDraw.Draw(txt)
         
         # Calculate size proportional to image (Reduced to 3.5%)
         # Using min(width, height) is safer for extreme aspect ratios
         font_size = max(15, int(min(width, height) * config.WATERMARK_FONT_SIZE_FACTOR)) 
-        font = get_font(font_size, config.MEME_FONT_NAME) # Using MEME_FONT_NAME for watermark for now
-        
-        text = config.WATERMARK_TEXT
-        
-        # Get text size
-        bbox = d.textbbox((0, 0), text, font=font)
-        text_w = bbox[2] - bbox[0]
-        text_h = bbox[3] - bbox[1]
+        layer, (left, top), text_h, margin = _watermark_sprite(font_size)
         
         # Position: bottom left with margin
-        margin = max(10, int(font_size / 2))
         x = margin
-        y = height - text_h - margin * 1.5 
+        y = math.floor(height - text_h - margin * 1.5)
         
-        # Dynamic outline width (proportional to font size)
-        outline_width = max(1, int(font_size // config.WATERMARK_OUTLINE_WIDTH_FACTOR))
-        
-        # Draw outline (black, 60% opacity)
-        for dx in range(-outline_width, outline_width+1):
-            for dy in range(-outline_width, outline_width+1):
-                if dx == 0 and dy == 0: continue
-                # Draw circular-ish stroke for better quality
-                if dx*dx + dy*dy > outline_width*outline_width: continue
-                
-                d.text((x+dx, y+dy), text, font=font, fill=(0, 0, 0, config.WATERMARK_ALPHA))
-        
-        # Draw main text (white, 60% opacity)
-        d.text((x, y), text, font=font, fill=(255, 255, 255, config.WATERMARK_ALPHA))
-        
-        # Composite
-        out = Image.alpha_composite(img, txt)
-        return out.convert("RGB")
+        # Composite only the corner the sprite covers
+        box = (x + left, y + top, x + left + layer.width, y + top + layer.height)
+        region = Image.alpha_composite(img.crop(box).convert("RGBA"), layer)
+        img.paste(region.convert("RGB"), box[:2])
+        return img
         
     except Exception as e:
         logging.error(f"Watermark failed: {e}")
         return img.convert("RGB")
 
-def generate_meme(template_path, top_text, bottom_text):
-    img = Image.open(template_path).convert("RGB")
+def generate_meme(img, top_text, bottom_text):
     draw = ImageDraw.Draw(img)
     width, height = img.size
     
     # Helper to calculate font size based on text length
-    def get_dynamic_font(text):
+    def get_dynamic_size(text):
         if not text:
-            return get_font(int(width / config.MEME_FONT_SIZE_LARGE_TEXT), config.MEME_FONT_NAME)
+            return int(width / config.MEME_FONT_SIZE_LARGE_TEXT)
             
         length = len(text)
         if length < 20:
@@ -126,61 +247,46 @@ def generate_meme(template_path, top_text, bottom_text):
             size = int(width / config.MEME_FONT_SIZE_SMALL_TEXT)
             
         # Minimum readable size
-        size = max(size, 20)
-        return get_font(size, config.MEME_FONT_NAME)
+        return max(size, 20)
     
     def draw_text_with_outline(text, y_pos, is_bottom=False):
         if not text: return
         
         # Get specific font for this text block
-        font = get_dynamic_font(text)
-        
-        lines = wrap_text(text, font, width - config.MEME_TEXT_PADDING, draw)
-        
-        total_text_height = 0
-        line_heights = []
-        for line in lines:
-            bbox = draw.textbbox((0, 0), line, font=font)
-            h = bbox[3] - bbox[1]
-            line_heights.append(h + 10)
-            total_text_height += h + 10
+        size = get_dynamic_size(text)
+        font = get_font(size, config.MEME_FONT_NAME)
+        lines, widths, heights = layout_text(text, config.MEME_FONT_NAME, size, width - config.MEME_TEXT_PADDING)
+        line_heights = [h + 10 for h in heights]
             
         current_y = y_pos
         if is_bottom:
-             current_y = height - total_text_height - config.MEME_TEXT_PADDING
+             current_y = height - sum(line_heights) - config.MEME_TEXT_PADDING
 
-        for i, line in enumerate(lines):
-            bbox = draw.textbbox((0, 0), line, font=font)
-            w = bbox[2] - bbox[0]
+        for line, w, line_height in zip(lines, widths, line_heights):
             x = (width - w) / 2
-            
-            # Outline
-            outline_width = config.MEME_TEXT_OUTLINE_WIDTH
-            for dx in range(-outline_width, outline_width+1):
-                for dy in range(-outline_width, outline_width+1):
-                    draw.text((x+dx, current_y+dy), line, font=font, fill="black")
-            
-            draw.text((x, current_y), line, font=font, fill="white")
-            current_y += line_heights[i]
+            # White text with a black outline in a single pass
+            draw.text(
+                (x, current_y), line, font=font, fill="white",
+                stroke_width=config.MEME_TEXT_OUTLINE_WIDTH, stroke_fill="black"
+            )
+            current_y += line_height
 
     draw_text_with_outline(top_text.upper(), config.MEME_TOP_TEXT_Y_OFFSET)
     draw_text_with_outline(bottom_text.upper(), config.MEME_BOTTOM_TEXT_Y_OFFSET, is_bottom=True)
     
     # Add Watermark
-    img = add_watermark(img)
-        
-    output_path = f"{config.GENERATED_DIR}/{uuid.uuid4()}.jpg"
-    img.save(output_path)
-    return output_path
+    return add_watermark(img)
 
-def generate_demotivator(template_path, text):
-    img = Image.open(template_path).convert("RGB")
-    
+def add_demotivator_border(img):
     # Рамка вокруг фото
     border_width = config.DEMOTIVATOR_BORDER_WIDTH
     img_with_border = ImageOps.expand(img, border=border_width, fill='white')
     # Дополнительная черная мини-рамка внутри (классика)
-    img_with_border = ImageOps.expand(img_with_border, border=config.DEMOTIVATOR_INNER_BORDER_WIDTH, fill='black')
+    return ImageOps.expand(img_with_border, border=config.DEMOTIVATOR_INNER_BORDER_WIDTH, fill='black')
+
+def generate_demotivator(img, text, bordered=False):
+    """bordered=True: img already went through add_demotivator_border (cached templates)."""
+    img_with_border = img if bordered else add_demotivator_border(img)
     
     iw, ih = img_with_border.size
     
@@ -192,10 +298,7 @@ def generate_demotivator(template_path, text):
     font = get_font(font_size, config.DEMOTIVATOR_FONT_NAME)
     
     # Считаем высоту текста
-    # Создаем временный канвас для измерения
-    dummy = Image.new('RGB', (1,1))
-    draw_dummy = ImageDraw.Draw(dummy)
-    lines = wrap_text(text, font, iw, draw_dummy)
+    lines, widths, _ = layout_text(text, config.DEMOTIVATOR_FONT_NAME, font_size, iw)
     
     text_height = len(lines) * (font_size + config.DEMOTIVATOR_LINE_SPACING)
     padding_bottom = max(padding_bottom_min, text_height + 50)
@@ -209,29 +312,20 @@ def generate_demotivator(template_path, text):
     draw = ImageDraw.Draw(canvas)
     
     current_y = padding_top + ih + 30
-    for line in lines:
-        bbox = draw.textbbox((0, 0), line, font=font)
-        w = bbox[2] - bbox[0]
+    for line, w in zip(lines, widths):
         x = (canvas_w - w) / 2
         draw.text((x, current_y), line, font=font, fill="white")
         current_y += font_size + config.DEMOTIVATOR_LINE_SPACING
     
     # Add Watermark
-    canvas = add_watermark(canvas)
-        
-    output_path = f"{config.GENERATED_DIR}/{uuid.uuid4()}.jpg"
-    
-    canvas.save(output_path)
-    return output_path
+    return add_watermark(canvas)
 
-def prepare_for_sticker(image_path):
+def prepare_for_sticker(img):
     """
-    Converts an image to Telegram sticker format:
-    - PNG or WEBP
-    - One side exactly 512px, the other <= 512px
+    Sizes an image for Telegram's sticker format: one side exactly 512px,
+    the other <= 512px. Renders already run at sticker size (see
+    pipeline.render), so this is usually a small adjustment or a no-op.
     """
-    img = Image.open(image_path).convert("RGBA")
-    
     width, height = img.size
     
     if width >= height:
@@ -240,9 +334,7 @@ def prepare_for_sticker(image_path):
     else:
         new_height = config.STICKER_SIZE
         new_width = int(width * (config.STICKER_SIZE / height))
-        
-    img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        
-    output_path = f"{config.GENERATED_DIR}/{uuid.uuid4()}.png"
-    img.save(output_path, "PNG")
-    return output_path
\ No newline at end of file
+
+    if (new_width, new_height) == img.size:
+        return img
+    return img.resize((new_width, new_height), Image.Resampling.LANCZOS)
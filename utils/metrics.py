@@ -0,0 +1,176 @@
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+import config
+
+# Prometheus text-format metrics.
+# Render stages run in the worker processes: there stage() timings and cache
+# stats are buffered and travel back with each job result (worker_report), and
+# the bot process merges them (merge_worker_report) before serving /metrics.
+
+_metrics = []
+_gauges = [] # (name, help, func returning [(labels dict, value), ...])
+_caches = {} # name -> stats() of an LRUCache-like object, see utils/cache.py
+_worker_caches = {} # worker pid -> {name: stats dict}, latest report of each worker
+_stage_buffer = None # list in worker processes, None in the bot process
+
+def _key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items() if value is not None))
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = _key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {_number(value)}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, buckets=config.METRICS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._values = {} # key -> [bucket counts..., sum, count]
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = _key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[i] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, entry in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, entry):
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', repr(float(bound)))])} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {entry[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_number(entry[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {entry[-1]}")
+        return lines
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Time spent in an update handler")
+HANDLER_CALLS = Counter("bot_handler_calls_total", "Update handler calls by outcome (error = raised)")
+STAGE_SECONDS = Histogram("render_stage_seconds", "Time per render stage: download, decode, resize, kernel, watermark, encode, upload")
+API_SECONDS = Histogram("telegram_api_seconds", "Bot API request latency by method")
+API_CALLS = Counter("telegram_api_calls_total", "Bot API requests by method and HTTP status")
+RENDER_JOBS = Counter("render_jobs_total", "Finished render jobs by outcome")
+RENDER_WAIT_SECONDS = Histogram("render_queue_wait_seconds", "Time a render job waited for a worker")
+
+@contextmanager
+def stage(name, operation=None):
+    """Times one render stage; operation labels the kernel stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if _stage_buffer is not None:
+            _stage_buffer.append((name, operation, elapsed))
+        else:
+            STAGE_SECONDS.observe(elapsed, stage=name, operation=operation)
+
+@asynccontextmanager
+async def track(handler):
+    """Counts and times an update handler. Works as a decorator for async handlers too."""
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        HANDLER_SECONDS.observe(time.perf_counter() - start, handler=handler)
+        HANDLER_CALLS.inc(handler=handler, outcome=outcome)
+
+def register_cache(name, stats):
+    """Exports hits, misses, items and hit ratio of a cache; stats() as LRUCache.stats."""
+    _caches[name] = stats
+
+def register_gauge(name, help, func):
+    """func() -> [(labels dict, value), ...], read on every scrape."""
+    _gauges.append((name, help, func))
+
+def collect_in_worker():
+    """Called in each worker process: stage timings are buffered for worker_report()."""
+    global _stage_buffer
+    _stage_buffer = []
+
+def worker_report():
+    """Stage timings since the last report and current cache stats of this worker."""
+    stages = list(_stage_buffer or ())
+    if _stage_buffer:
+        _stage_buffer.clear()
+    return {"pid": os.getpid(), "stages": stages, "caches": {name: stats() for name, stats in _caches.items()}}
+
+def merge_worker_report(report):
+    for name, operation, elapsed in report["stages"]:
+        STAGE_SECONDS.observe(elapsed, stage=name, operation=operation)
+    _worker_caches[report["pid"]] = report["caches"]
+
+def _cache_lines():
+    totals = {}
+    for caches in [{name: stats() for name, stats in _caches.items()}, *_worker_caches.values()]:
+        for name, stats in caches.items():
+            total = totals.setdefault(name, {"hits": 0, "misses": 0, "items": 0})
+            for field in total:
+                total[field] += stats.get(field, 0)
+
+    families = [
+        ("cache_hits_total", "counter", "Cache hits, summed over processes", "hits"),
+        ("cache_misses_total", "counter", "Cache misses, summed over processes", "misses"),
+        ("cache_items", "gauge", "Entries held, summed over processes", "items"),
+    ]
+    lines = []
+    for metric, kind, help, field in families:
+        lines += [f"# HELP {metric} {help}", f"# TYPE {metric} {kind}"]
+        lines += [f"{metric}{_format_labels(_key({'cache': name}))} {total[field]}" for name, total in sorted(totals.items())]
+    lines += ["# HELP cache_hit_ratio Hits / lookups since start", "# TYPE cache_hit_ratio gauge"]
+    for name, total in sorted(totals.items()):
+        lookups = total["hits"] + total["misses"]
+        lines.append(f"cache_hit_ratio{_format_labels(_key({'cache': name}))} {_number(total['hits'] / lookups if lookups else 0.0)}")
+    return lines
+
+def expose():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        lines += metric.expose()
+    for name, help, func in _gauges:
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+        lines += [f"{name}{_format_labels(_key(labels))} {_number(value)}" for labels, value in func()]
+    lines += _cache_lines()
+    return "\n".join(lines) + "\n"
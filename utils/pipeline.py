@@ -0,0 +1,91 @@
+import io
+import config
+from utils import effects, metrics, template_store
+from utils.effect_chain import input_size
+from utils.render_engine import checkpoint
+from utils.template_store import TemplateHandle
+from utils.upload_cache import Upload
+from utils.image_generator import generate_meme, generate_demotivator, prepare_for_sticker
+
+# Render operations by name: main.py sends the name, the worker runs the function.
+OPERATIONS = {
+    "meme": generate_meme,
+    "demotivator": generate_demotivator,
+    "liquid": effects.liquid_resize,
+    "deepfry": effects.deep_fry_effect,
+    "warp": effects.warp_effect,
+    "crispy": effects.crispy_effect,
+    "bulge": effects.lens_bulge_effect,
+    "pinch": effects.lens_pinch_effect,
+}
+
+# Operations that draw on their input image; they get a private copy of cached images
+IN_PLACE_OPERATIONS = {"meme"}
+
+# Cached image variant per operation, and the kwargs telling the operation it got one
+TEMPLATE_VARIANTS = {
+    "demotivator": ("demotivator", {"bordered": True}),
+}
+
+# Extra JPEG options per operation, used when it is anywhere in the chain
+# (deep fry relies on a low-quality encode)
+JPEG_OPTIONS = {
+    "deepfry": {"quality": config.DEEPFRY_JPEG_QUALITY},
+}
+
+def load(source, operation, max_size=None):
+    """
+    Gallery templates (paths) and user photos (Upload) come from the template
+    store; plain bytes are decoded fresh. All come sized for max_size;
+    operation picks the cached variant (None for none).
+    Returns (handle, extra kwargs for the operation).
+    """
+    if isinstance(source, (str, Upload)):
+        variant, extra = TEMPLATE_VARIANTS.get(operation, (None, {}))
+        if isinstance(source, Upload):
+            return template_store.get_upload(source, variant, max_size), extra
+        return template_store.get(source, variant, max_size), extra
+    return TemplateHandle(template_store.decode(io.BytesIO(source), max_size), owned=True), {}
+
+def encode(img, fmt, **options):
+    buffer = io.BytesIO()
+    img.save(buffer, fmt, **options)
+    return buffer.getvalue()
+
+def encode_sticker(img):
+    """
+    WebP, starting at STICKER_WEBP_QUALITY and stepping down until it fits
+    Telegram's STICKER_MAX_BYTES.
+    """
+    for quality in range(config.STICKER_WEBP_QUALITY, config.STICKER_WEBP_MIN_QUALITY - 1, -10):
+        data = encode(img, "WEBP", quality=quality, method=config.STICKER_WEBP_METHOD)
+        if len(data) <= config.STICKER_MAX_BYTES:
+            return data
+    raise ValueError(f"Sticker is {len(data)} bytes even at WebP quality {quality}")
+
+def render(source, steps, sticker=False):
+    """
+    Decode once at the chain's working size (or reuse a cached image), run
+    every step in memory, encode once. steps: [(operation, args, kwargs), ...]
+    in order, see utils/effect_chain.py. Returns JPEG bytes, or sticker-ready
+    WebP bytes when sticker=True: stickers are rendered at sticker size, not
+    scaled down from a full-size render.
+    """
+    first = steps[0][0]
+    # A cached variant stands in for the operation's own first stage, so only single steps use one
+    handle, extra = load(source, first if len(steps) == 1 else None, input_size(steps, sticker))
+    img = handle.writable() if first in IN_PLACE_OPERATIONS else handle.image
+
+    jpeg_options = {}
+    for operation, args, kwargs in steps:
+        checkpoint()
+        # Later steps get the previous step's output, which is already private
+        with metrics.stage("kernel", operation):
+            img = OPERATIONS[operation](img, *args, **{**extra, **kwargs})
+        extra = {}
+        jpeg_options.update(JPEG_OPTIONS.get(operation, {}))
+
+    with metrics.stage("encode"):
+        if sticker:
+            return encode_sticker(prepare_for_sticker(img))
+        return encode(img, "JPEG", **jpeg_options)
@@ -0,0 +1,268 @@
+import asyncio
+import bisect
+import importlib
+import itertools
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+import config
+from utils import metrics
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+
+class RenderQueueFull(Exception):
+    """Raised when RENDER_MAX_QUEUE jobs are already waiting or running."""
+
+class RenderCancelled(Exception):
+    """Raised to the caller (and inside the worker) when a job is cancelled."""
+
+# Cancellation flags shared with the workers, indexed by job id modulo their
+# count. Far more slots than jobs can be alive at once (RENDER_MAX_QUEUE), and
+# a slot is cleared when its job starts.
+_CANCEL_SLOTS = 1024
+
+_executor = None
+_cancel_flags = None
+_ready = False
+_stopping = False # Set by shutdown(): nothing is dispatched any more
+
+# Scheduler state, bot process only (touched from the event loop thread)
+_job_ids = itertools.count(1)
+_waiting = [] # _Job, sorted by (deadline, id)
+_running = {} # job id -> _Job
+
+# Worker process state
+_current_job = None
+
+class _Job:
+    """
+    One render waiting for or holding a worker slot.
+
+    Jobs start in order of deadline = submit time + estimated cost in seconds:
+    a cheap job overtakes expensive ones submitted shortly before it, while a
+    long-waiting expensive job eventually comes first, so nothing starves.
+    """
+
+    def __init__(self, target, args, kwargs, user_id, group, max_running, cost, replace, on_position):
+        self.id = next(_job_ids)
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+        self.user_id = user_id
+        self.group = group
+        self.max_running = max_running
+        self.replace = replace
+        self.submitted = time.monotonic()
+        self.deadline = self.submitted + cost
+        self.on_position = on_position
+        self.position = None
+        self.future = asyncio.get_running_loop().create_future()
+
+    def __lt__(self, other):
+        return (self.deadline, self.id) < (other.deadline, other.id)
+
+def _init_worker(cancel_flags):
+    """
+    Runs once in every worker process.
+    Compiles the numba kernels so the first real job does not pay for JIT.
+    """
+    global _cancel_flags
+    _cancel_flags = cancel_flags
+    metrics.collect_in_worker()
+
+    if config.EFFECTS_NUMBA_THREADS:
+        import numba
+        numba.set_num_threads(config.EFFECTS_NUMBA_THREADS)
+
+    from utils.effects import warm_up
+    warm_up()
+
+def _ping():
+    return True
+
+def _call(target, args, kwargs, job_id=None):
+    """
+    Runs in the worker: resolves "module:function" and calls it.
+    The bot process never imports the heavy image modules itself.
+    Returns (result, metrics.worker_report()).
+    """
+    global _current_job
+    module_name, func_name = target.split(":")
+    func = getattr(importlib.import_module(module_name), func_name)
+    _current_job = job_id
+    try:
+        return func(*args, **kwargs), metrics.worker_report()
+    finally:
+        _current_job = None
+
+def checkpoint():
+    """
+    Called by long-running render code between stages. Raises RenderCancelled
+    if the job running in this worker has been cancelled; a no-op outside the
+    worker pool.
+    """
+    if _current_job is not None and _cancel_flags[_current_job % _CANCEL_SLOTS]:
+        raise RenderCancelled(f"job {_current_job} cancelled")
+
+def _get_executor():
+    global _executor, _cancel_flags
+    if _executor is None:
+        _cancel_flags = multiprocessing.RawArray('b', _CANCEL_SLOTS)
+        _executor = ProcessPoolExecutor(
+            max_workers=config.RENDER_WORKERS,
+            initializer=_init_worker,
+            initargs=(_cancel_flags,)
+        )
+    return _executor
+
+async def start():
+    """
+    Spawns the worker pool and waits until every worker has finished warming up.
+    """
+    global _ready
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+    await asyncio.gather(*(loop.run_in_executor(executor, _ping) for _ in range(config.RENDER_WORKERS)))
+    logging.info(f"Render engine ready: {config.RENDER_WORKERS} workers, queue limit {config.RENDER_MAX_QUEUE}, "
+                 f"{config.RENDER_USER_MAX_RUNNING} running per user")
+    _ready = True
+
+def ready():
+    """True once start() has warmed up every worker."""
+    return _ready
+
+def _can_start(job):
+    """Whether the job's user has a free slot in its group."""
+    if job.user_id is None:
+        return True
+    running = sum(1 for other in _running.values() if (other.user_id, other.group) == (job.user_id, job.group))
+    return running < job.max_running
+
+def _dispatch():
+    """Starts waiting jobs, in deadline order, while workers and per-user limits allow."""
+    if _stopping or not _waiting:
+        return
+    executor = _get_executor()
+    loop = asyncio.get_running_loop()
+    while len(_running) < config.RENDER_WORKERS:
+        job = next((job for job in _waiting if _can_start(job)), None)
+        if job is None:
+            break
+        _waiting.remove(job)
+        _running[job.id] = job
+        _cancel_flags[job.id % _CANCEL_SLOTS] = 0
+        metrics.RENDER_WAIT_SECONDS.observe(time.monotonic() - job.submitted)
+        task = loop.run_in_executor(executor, _call, job.target, job.args, job.kwargs, job.id)
+        task.add_done_callback(lambda task, job=job: _finished(job, task))
+    _report_positions()
+
+def _finished(job, task):
+    del _running[job.id]
+    # Always retrieve the outcome, also for jobs the caller no longer waits for
+    error = RenderCancelled(f"job {job.id} cancelled") if task.cancelled() else task.exception()
+    if error is None:
+        result, report = task.result()
+        metrics.merge_worker_report(report)
+    metrics.RENDER_JOBS.inc(outcome="cancelled" if isinstance(error, RenderCancelled) else "error" if error else "ok")
+    if not job.future.done():
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+    _dispatch()
+
+def _report_positions():
+    """Tells every waiting job its place in the queue (1 = next), and started jobs 0."""
+    for position, job in itertools.chain(((i + 1, job) for i, job in enumerate(_waiting)),
+                                         ((0, job) for job in _running.values())):
+        if job.on_position is not None and job.position != position and not job.future.done():
+            job.position = position
+            asyncio.ensure_future(_notify(job, position))
+
+async def _notify(job, position):
+    try:
+        await job.on_position(position)
+    except Exception as e:
+        logging.warning(f"Queue position callback failed: {e}")
+
+def _cancel(job):
+    """
+    A waiting job is dropped; a running one is flagged and stops at the
+    worker's next checkpoint(), keeping its slot until then. Either way the
+    caller gets RenderCancelled right away.
+    """
+    if job in _waiting:
+        _waiting.remove(job)
+    elif job.id in _running:
+        _cancel_flags[job.id % _CANCEL_SLOTS] = 1
+    if not job.future.done():
+        job.future.set_exception(RenderCancelled(f"job {job.id} cancelled"))
+
+def cancel_user(user_id):
+    """
+    Cancels the waiting or running jobs a user submitted with replace=True.
+    Returns how many there were. Jobs submitted with replace=False (e.g. a
+    sticker pack being built) are left alone.
+    """
+    jobs = [job for job in _waiting + list(_running.values())
+            if job.user_id == user_id and job.replace and not job.future.done()]
+    for job in jobs:
+        _cancel(job)
+    if jobs:
+        logging.info(f"Cancelled {len(jobs)} render job(s) of user {user_id}")
+        _dispatch()
+    return len(jobs)
+
+async def submit(target, args=(), kwargs=None, *, user_id=None, group=None, max_running=None,
+                 cost=0.0, replace=False, on_position=None):
+    """
+    Runs a CPU-bound function in the worker pool through the scheduler and
+    awaits its result. target is a "module:function" string.
+
+    user_id, group: at most max_running (default RENDER_USER_MAX_RUNNING) of
+    a user's jobs in the same group run at once, so e.g. a batch can have its
+    own group and allowance next to the user's interactive renders.
+    cost: estimated seconds of work; cheaper jobs start first (see _Job).
+    replace: cancel the user's earlier replace=True jobs, which they no
+    longer wait for; this job can in turn be replaced by a later one.
+    on_position: async callback(position), called as the job moves up the
+    queue; 0 means it has started.
+    Raises RenderQueueFull or RenderCancelled.
+    """
+    if _stopping:
+        raise RenderCancelled("render engine is shut down")
+    if replace and user_id is not None:
+        cancel_user(user_id)
+    if len(_waiting) + len(_running) >= config.RENDER_MAX_QUEUE:
+        raise RenderQueueFull(f"{len(_waiting) + len(_running)} render jobs already queued")
+
+    job = _Job(target, args, kwargs or {}, user_id, group, max_running or config.RENDER_USER_MAX_RUNNING,
+               cost, replace, on_position)
+    bisect.insort(_waiting, job)
+    _dispatch()
+    try:
+        return await job.future
+    except asyncio.CancelledError:
+        # The awaiting handler itself was cancelled (e.g. on shutdown)
+        _cancel(job)
+        _dispatch()
+        raise
+
+metrics.register_gauge("render_queue_jobs", "Render jobs waiting for or holding a worker",
+                       lambda: [({"state": "waiting"}, len(_waiting)), ({"state": "running"}, len(_running))])
+
+def shutdown():
+    """Stops the workers. Jobs that have not started yet are cancelled."""
+    global _executor, _ready, _stopping
+    _ready = False
+    _stopping = True
+    for job in list(_waiting):
+        _cancel(job)
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+        logging.info("Render engine stopped")
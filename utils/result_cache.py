@@ -0,0 +1,61 @@
+import config
+from utils.cache import LRUCache
+from utils import metrics
+
+# Finished renders: key -> {"bytes": encoded image, "file_id": Telegram file_id or None}.
+# Lives in the bot process, so repeats skip both the worker and the upload.
+_results = LRUCache(
+    max_items=config.RESULT_CACHE_MAX_ITEMS,
+    ttl=config.RESULT_CACHE_TTL,
+    max_bytes=config.RESULT_CACHE_MAX_MB * 1024 * 1024,
+    sizeof=lambda entry: len(entry["bytes"]),
+)
+
+def _collapse(text):
+    # wrap_text splits on any whitespace, so runs of spaces and newlines render the same
+    return " ".join(text.split())
+
+# How each operation's text arguments are normalized; must match what the renderer
+# does. Meme font size depends on the text length, so main.split_meme_text collapses
+# whitespace before rendering rather than leaving it to wrap_text.
+TEXT_NORMALIZERS = {
+    "meme": lambda text: _collapse(text).upper(),
+    "demotivator": _collapse,
+}
+
+def _step_key(operation, args, kwargs):
+    normalize = TEXT_NORMALIZERS.get(operation, str)
+    return (operation, tuple(normalize(a) for a in args), tuple(sorted(kwargs.items())))
+
+def result_key(source_id, steps, sticker=False):
+    """
+    Key for one render of the effect_chain steps. source_id identifies the input
+    image by content: ("template", sha1) for gallery templates, ("upload",
+    file_unique_id) for photos.
+    """
+    return (source_id, tuple(_step_key(*step) for step in steps), sticker)
+
+def get(key):
+    """Cached encoded bytes, or None."""
+    entry = _results.get(key)
+    return entry["bytes"] if entry is not None else None
+
+def put(key, image_bytes):
+    _results.set(key, {"bytes": image_bytes, "file_id": None})
+
+def file_id(key):
+    entry = _results.peek(key)
+    return entry["file_id"] if entry is not None else None
+
+def remember_file_id(key, value):
+    entry = _results.peek(key)
+    if entry is not None:
+        entry["file_id"] = value
+
+def forget_file_id(key):
+    remember_file_id(key, None)
+
+def stats():
+    return _results.stats()
+
+metrics.register_cache("result", stats)
@@ -0,0 +1,33 @@
+import logging
+import time
+from contextlib import contextmanager
+
+# Imported first thing in main.py, so this is close to process start
+PROCESS_START = time.perf_counter()
+
+_stages = []
+_first_update_seen = False
+
+@contextmanager
+def stage(label):
+    """Times a startup stage, e.g. a group of imports."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _stages.append((label, time.perf_counter() - start))
+
+def since_start():
+    return time.perf_counter() - PROCESS_START
+
+def report_ready():
+    """Logs per-stage timings once the bot is about to receive updates."""
+    parts = ", ".join(f"{label} {elapsed * 1000:.0f} ms" for label, elapsed in _stages)
+    logging.info(f"Startup: {parts}")
+    logging.info(f"Startup: ready for updates after {since_start():.2f}s")
+
+def report_first_update():
+    global _first_update_seen
+    if not _first_update_seen:
+        _first_update_seen = True
+        logging.info(f"Startup: first update handled after {since_start():.2f}s")
@@ -0,0 +1,117 @@
+import json
+import logging
+import os
+from utils.files import image_size, sha1, write_json
+
+TEMPLATE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+class TemplateIndex:
+    """
+    Gallery templates with stable ids, persisted as JSON.
+
+    Every file name gets an id once and keeps it: ids are never reused, and a
+    removed template leaves a tombstone, so ids in old callback buttons keep
+    pointing at the same template (or at nothing) across reloads and restarts.
+    The gallery shows active templates sorted by name.
+
+    refresh() rescans the directory (stat only, re-hashing changed files) and
+    is meant to run in a thread; readers always see a complete snapshot.
+    """
+
+    def __init__(self, directory, index_path):
+        self.directory = directory
+        self.index_path = index_path
+        self._entries = self._load() # name -> entry
+        self._broken = {} # name -> mtime_ns of a file that failed to open, not retried until it changes
+        self._publish()
+
+    def _load(self):
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                return {entry["name"]: entry for entry in json.load(f)}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Template index {self.index_path} unreadable, rebuilding: {e}")
+            return {}
+
+    def _save(self):
+        write_json(self.index_path, sorted(self._entries.values(), key=lambda e: e["id"]))
+
+    def _publish(self):
+        # Swapped in one assignment each, so handlers never see a half-built list
+        active = sorted((e for e in self._entries.values() if not e["removed"]), key=lambda e: e["name"])
+        self._by_id = {e["id"]: e for e in active}
+        self._by_path = {e["path"]: e for e in active}
+        self._active = active
+
+    def active(self):
+        """Active templates in gallery order."""
+        return self._active
+
+    def get(self, template_id):
+        """Active template by id, or None if it was removed (or never existed)."""
+        return self._by_id.get(template_id)
+
+    def by_path(self, path):
+        return self._by_path.get(path)
+
+    def position(self, template_id):
+        entry = self._by_id.get(template_id)
+        return self._active.index(entry) if entry is not None else None
+
+    def refresh(self):
+        """Brings the index in line with the directory. Returns True if anything changed."""
+        entries = {name: dict(entry) for name, entry in self._entries.items()}
+        next_id = max((e["id"] for e in entries.values()), default=-1) + 1
+        seen = set()
+        added, updated, removed = [], [], []
+
+        for name in sorted(os.listdir(self.directory)):
+            if not name.lower().endswith(TEMPLATE_EXTENSIONS):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if self._broken.get(name) == stat.st_mtime_ns:
+                continue
+            seen.add(name)
+            entry = entries.get(name)
+            if entry and not entry["removed"] and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+                continue
+
+            try:
+                digest = sha1(path)
+                width, height = image_size(path)
+            except Exception as e:
+                logging.error(f"Skipping template {path}: {e}")
+                self._broken[name] = stat.st_mtime_ns
+                seen.discard(name)
+                continue
+
+            if entry is None:
+                entry = entries[name] = {"id": next_id, "name": name}
+                next_id += 1
+                added.append(name)
+            elif entry["removed"] or entry.get("sha1") != digest:
+                updated.append(name)
+            entry.update(
+                path=path, width=width, height=height,
+                size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha1=digest, removed=False
+            )
+
+        for name, entry in entries.items():
+            if name not in seen and not entry["removed"]:
+                entry["removed"] = True
+                removed.append(name)
+
+        changed = entries != self._entries
+        if changed:
+            self._entries = entries
+            self._publish()
+            self._save()
+        if added or updated or removed:
+            logging.info(f"Templates: +{len(added)} ~{len(updated)} -{len(removed)}, {len(self._active)} active")
+        return changed
@@ -0,0 +1,90 @@
+import io
+import math
+import os
+from PIL import Image
+import config
+from utils.cache import LRUCache
+from utils import metrics
+from utils.effects import resize_image_keep_ratio
+from utils.image_generator import add_demotivator_border
+
+def _image_bytes(img):
+    return img.width * img.height * len(img.getbands())
+
+# Decoded gallery templates and user uploads (and their derived versions), per
+# worker process, at the size a render works at. Templates are keyed by
+# (path, mtime, max_size, variant), so an edited template is decoded again;
+# uploads by their Telegram file_unique_id.
+_store = LRUCache(max_bytes=config.TEMPLATE_STORE_MAX_MB * 1024 * 1024, sizeof=_image_bytes)
+
+# Derived versions of a template, built from its decoded RGB image
+VARIANTS = {
+    "demotivator": add_demotivator_border,
+}
+
+class TemplateHandle:
+    """
+    Copy-on-write access to an image.
+
+    .image is shared with the store and must not be modified. writable()
+    returns an image the caller may draw on: a private copy is made on the
+    first call, unless the handle already owns its image (e.g. a freshly
+    decoded upload).
+    """
+
+    def __init__(self, image, owned=False):
+        self._image = image
+        self._owned = owned
+
+    @property
+    def image(self):
+        return self._image
+
+    def writable(self):
+        if not self._owned:
+            self._image = self._image.copy()
+            self._owned = True
+        return self._image
+
+def _cached(key, decode, variant):
+    img = _store.get(key)
+    if img is None:
+        if variant is None:
+            img = decode()
+        else:
+            img = VARIANTS[variant](_cached(key[:-1] + (None,), decode, None))
+        _store.set(key, img)
+    return img
+
+def decode(fp, max_size=None):
+    """
+    Decodes a path or file object to RGB, with the longest side at most max_size.
+    JPEGs are decoded in draft mode: libjpeg scales by 1/2, 1/4 or 1/8 while
+    decoding, never below max_size, so the full-size bitmap is never built.
+    """
+    with metrics.stage("decode"):
+        img = Image.open(fp)
+        if max_size:
+            scale = max_size / max(img.size)
+            if scale < 1:
+                img.draft("RGB", (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+        img = img.convert("RGB")
+    if max_size:
+        with metrics.stage("resize"):
+            img = resize_image_keep_ratio(img, max_size)
+    return img
+
+def get(path, variant=None, max_size=None):
+    """Returns a handle to the decoded RGB template, or to one of its VARIANTS, sized for max_size."""
+    key = ("template", path, os.stat(path).st_mtime_ns, max_size, variant)
+    return TemplateHandle(_cached(key, lambda: decode(path, max_size), variant))
+
+def get_upload(upload, variant=None, max_size=None):
+    """Same as get() for a user photo (utils.upload_cache.Upload)."""
+    key = ("upload", upload.unique_id, max_size, variant)
+    return TemplateHandle(_cached(key, lambda: decode(io.BytesIO(upload.data), max_size), variant))
+
+def stats():
+    return _store.stats()
+
+metrics.register_cache("template_store", stats)
@@ -0,0 +1,50 @@
+import asyncio
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Handles up to max_concurrent_updates updates at once, but one at a time
+    per user (per chat for updates without a user), in arrival order.
+
+    ConversationHandler keeps its state and user_data per user and assumes
+    their updates do not overlap; updates of different users still run side
+    by side. An update waiting for its user's turn holds one of the
+    max_concurrent_updates slots, so keep the limit well above the number of
+    updates one user sends while the previous one is handled.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._locks = {} # user or chat id -> [asyncio.Lock, updates holding or waiting for it]
+
+    @staticmethod
+    def _key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user is not None:
+            return ("user", update.effective_user.id)
+        if update.effective_chat is not None:
+            return ("chat", update.effective_chat.id)
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            await coroutine
+            return
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
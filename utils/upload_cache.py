@@ -0,0 +1,41 @@
+from collections import namedtuple
+import config
+from utils.cache import LRUCache
+from utils import metrics
+
+# A downloaded user photo. unique_id is Telegram's file_unique_id: the same for
+# every forward or reply of that photo, so it identifies the content.
+Upload = namedtuple("Upload", ["unique_id", "data"])
+
+_uploads = LRUCache(
+    ttl=config.UPLOAD_CACHE_TTL,
+    max_bytes=config.UPLOAD_CACHE_MAX_MB * 1024 * 1024,
+    sizeof=lambda upload: len(upload.data),
+)
+
+def pick_photo_size(sizes, min_side=None):
+    """
+    Smallest PhotoSize whose longest side is at least min_side (None = largest).
+    Falls back to the largest one when none is big enough.
+    """
+    sizes = sorted(sizes, key=lambda p: p.width * p.height)
+    if min_side:
+        for photo in sizes:
+            if max(photo.width, photo.height) >= min_side:
+                return photo
+    return sizes[-1]
+
+async def fetch(photo):
+    """Returns the Upload for a PhotoSize, downloading it only the first time."""
+    upload = _uploads.get(photo.file_unique_id)
+    if upload is None:
+        with metrics.stage("download"):
+            photo_file = await photo.get_file()
+            upload = Upload(photo.file_unique_id, bytes(await photo_file.download_as_bytearray()))
+        _uploads.set(photo.file_unique_id, upload)
+    return upload
+
+def stats():
+    return _uploads.stats()
+
+metrics.register_cache("upload", stats)
@@ -0,0 +1,99 @@
+import asyncio
+import json
+import logging
+import signal
+from aiohttp import web
+from telegram import Update
+import config
+from utils import metrics, render_engine
+
+# One asyncio HTTP server on PORT, in the bot's own event loop:
+# /health and /ready for the platform, /metrics for Prometheus, plus the
+# Telegram webhook in webhook mode.
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+def webhook_mode():
+    return bool(config.WEBHOOK_URL)
+
+def create_app(application):
+    async def health(request):
+        # Liveness: the event loop answers
+        return web.Response(text="Bot is alive!")
+
+    async def ready(request):
+        # Readiness: updates are being processed and the render workers are warm
+        if application.running and render_engine.ready():
+            return web.Response(text="ready")
+        return web.Response(status=503, text="starting")
+
+    async def metrics_text(request):
+        return web.Response(body=metrics.expose().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def webhook(request):
+        if config.WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != config.WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            payload = await request.json()
+            if not isinstance(payload, dict):
+                raise TypeError(f"expected an object, got {type(payload).__name__}")
+            update = Update.de_json(payload, application.bot)
+        except (json.JSONDecodeError, KeyError, TypeError, AttributeError) as e:
+            logging.warning(f"Bad webhook payload: {e}")
+            return web.Response(status=400)
+        # Handled by the application's own update loop; Telegram only waits for the 200
+        await application.update_queue.put(update)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_get("/", health)
+    app.router.add_get("/health", health)
+    app.router.add_get("/ready", ready)
+    app.router.add_get("/metrics", metrics_text)
+    if webhook_mode():
+        app.router.add_post(config.WEBHOOK_PATH, webhook)
+    return app
+
+async def run(application):
+    """
+    Serves HTTP and runs the bot until SIGINT/SIGTERM: receives updates on
+    the webhook if WEBHOOK_URL is set, otherwise polls. Mirrors
+    Application.run_polling: initialize, post_init, start, then stop,
+    shutdown and post_shutdown.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # Health checks answer while the bot is still starting up
+    runner = web.AppRunner(create_app(application), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", config.PORT).start()
+    logging.info(f"HTTP server on port {config.PORT}")
+
+    try:
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        if webhook_mode():
+            url = config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH
+            await application.bot.set_webhook(
+                url, secret_token=config.WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES,
+                max_connections=config.WEBHOOK_MAX_CONNECTIONS
+            )
+            logging.info(f"Receiving updates via webhook {url}")
+        else:
+            await application.updater.start_polling()
+            logging.info("Receiving updates via polling")
+        await application.start()
+        await stop.wait()
+    finally:
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await runner.cleanup()